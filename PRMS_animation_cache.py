@@ -0,0 +1,212 @@
+"""
+On-disk cache of parsed PRMS animation files
+
+Each animation file is stored as one raw binary file per column, plus a json file with the parsed
+header information. Entries are checked against the modification time and size of the source file,
+and read back as memory-mapped arrays, so that repeated runs skip the text parsing entirely.
+"""
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import pandas as pd
+
+
+class AnimationCache:
+    # header attributes of AnimationFile that are saved with each entry
+    header_attributes = ['header', 'header_row', 'delimiter', 'column_names', 'timestamp_column', 'formats_line']
+
+    def __init__(self, cache_dir, max_size=10e9):
+        # cache_dir: folder for the cached files (created if it doesn't exist)
+        # max_size: maximum total size of the cache, in bytes;
+        # the least recently used entries are removed when the cache grows beyond this
+
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def entry_path(self, infile):
+        name = hashlib.md5(os.path.abspath(infile).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, name)
+
+    def source_info(self, infile):
+        stat = os.stat(infile)
+        return {'source': os.path.abspath(infile), 'mtime': stat.st_mtime, 'size': stat.st_size}
+
+    def read_metadata(self, infile):
+        """Return the metadata for a cached animation file, or None if there is no
+        entry, or if the source file has changed since it was cached.
+        """
+        metafile = os.path.join(self.entry_path(infile), 'meta.json')
+        if not os.path.isfile(metafile):
+            return None
+        try:
+            with open(metafile) as input_file:
+                meta = json.load(input_file)
+        except ValueError:
+            return None
+        source = self.source_info(infile)
+        if meta['mtime'] != source['mtime'] or meta['size'] != source['size']:
+            return None
+        # mark the entry as recently used
+        os.utime(metafile, None)
+        return meta
+
+    def read_header(self, ani_file):
+        """Set the header attributes of an AnimationFile from the cache.
+        Returns True if a valid entry was found.
+        """
+        meta = self.read_metadata(ani_file.infile)
+        if meta is None:
+            return False
+        for attr in self.header_attributes:
+            value = meta[attr]
+            if isinstance(value, unicode):
+                value = str(value)
+            elif attr in ['header', 'column_names']:
+                value = [str(v) for v in value]
+            setattr(ani_file, attr, value)
+        ani_file.nrows = meta['nrows']
+        return True
+
+    def columns(self, ani_file):
+        """Return a dictionary of memory-mapped arrays, one for each column of a cached animation file.
+        """
+        meta = self.read_metadata(ani_file.infile)
+        path = self.entry_path(ani_file.infile)
+        columns = {}
+        for c in meta['column_names']:
+            c = str(c)
+            if meta['nrows'] == 0:
+                columns[c] = np.array([], dtype=meta['dtypes'][c])
+            else:
+                columns[c] = np.memmap(os.path.join(path, '{}.bin'.format(c)), dtype=meta['dtypes'][c],
+                                       mode='r', shape=(meta['nrows'],))
+        return columns
+
+    def to_dataframe(self, ani_file, columns, start=0, stop=None):
+        # build a dataframe laid out like AnimationFile.df, from rows start:stop of the cached columns
+        timestamps = pd.DatetimeIndex(columns[ani_file.timestamp_column][start:stop].view('datetime64[ns]'),
+                                      name=ani_file.timestamp_column)
+        df = pd.DataFrame(dict([(c, np.array(columns[c][start:stop])) for c in ani_file.column_names
+                                if c != ani_file.timestamp_column]), index=timestamps)
+        df.insert(0, ani_file.timestamp_column, timestamps)
+        return df[ani_file.column_names]
+
+    def window(self, ani_file, columns, start=None, end=None):
+        # rows of the records from start to end (inclusive), found by searching the sorted timestamps
+        timestamps = columns[ani_file.timestamp_column]
+        first, last = 0, ani_file.nrows
+        if start is not None:
+            first = np.searchsorted(timestamps, pd.Timestamp(start).value, side='left')
+        if end is not None:
+            last = np.searchsorted(timestamps, pd.Timestamp(end).value, side='right')
+        return first, last
+
+    def read(self, ani_file, start=None, end=None):
+        """Return the cached animation file as a dataframe,
+        optionally only the records between two dates (inclusive).
+        """
+        columns = self.columns(ani_file)
+        return self.to_dataframe(ani_file, columns, *self.window(ani_file, columns, start, end))
+
+    def iter_chunks(self, ani_file, chunksize, start=None, end=None):
+        """Return a generator of dataframes of at most chunksize rows from a cached animation file,
+        optionally only the records between two dates (inclusive).
+        """
+        columns = self.columns(ani_file)
+        first, last = self.window(ani_file, columns, start, end)
+        for row in range(first, last, chunksize):
+            yield self.to_dataframe(ani_file, columns, row, min(row + chunksize, last))
+
+    def writer(self, ani_file):
+        return CacheWriter(self, ani_file)
+
+    def write(self, ani_file, df):
+        """Add an animation file that was read into a dataframe to the cache.
+        """
+        writer = self.writer(ani_file)
+        writer.append(df)
+        writer.close()
+
+    def size(self, path=None):
+        if path is None:
+            path = self.cache_dir
+        return sum([os.path.getsize(os.path.join(root, f))
+                    for root, dirs, files in os.walk(path) for f in files])
+
+    def evict(self):
+        """Remove the least recently used entries until the cache is below max_size.
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            metafile = os.path.join(self.cache_dir, name, 'meta.json')
+            if os.path.isfile(metafile):
+                entries.append((os.path.getmtime(metafile), os.path.join(self.cache_dir, name)))
+        entries.sort()
+        sizes = dict([(path, self.size(path)) for last_used, path in entries])
+        total = sum(sizes.values())
+        for last_used, path in entries:
+            if total <= self.max_size:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= sizes[path]
+
+
+class CacheWriter:
+    # writes an animation file to the cache, one block of rows at a time;
+    # the entry is built in a temporary folder and only moved into place by close(),
+    # so that an incomplete entry is never read, even by another process
+
+    def __init__(self, cache, ani_file):
+        self.cache = cache
+        self.ani_file = ani_file
+        self.source = cache.source_info(ani_file.infile)
+        self.path = cache.entry_path(ani_file.infile)
+        self.temp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        if os.path.isdir(self.temp_path):
+            shutil.rmtree(self.temp_path)
+        os.makedirs(self.temp_path)
+        self.nrows = 0
+        self.dtypes = {}
+        for c in ani_file.column_names:
+            # timestamps are stored as nanoseconds; hru numbers as integers; everything else as floats
+            if c == ani_file.timestamp_column or c == 'nhru':
+                self.dtypes[c] = 'int64'
+            else:
+                self.dtypes[c] = 'float64'
+        self.files = dict([(c, open(os.path.join(self.temp_path, '{}.bin'.format(c)), 'wb'))
+                           for c in ani_file.column_names])
+
+    def append(self, df):
+        for c in self.ani_file.column_names:
+            values = df[c].values
+            if c == self.ani_file.timestamp_column:
+                values = values.view('int64')
+            self.files[c].write(np.ascontiguousarray(values, dtype=self.dtypes[c]).tostring())
+        self.nrows += len(df)
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        meta = dict([(attr, getattr(self.ani_file, attr)) for attr in self.cache.header_attributes])
+        meta.update(self.source)
+        meta['nrows'] = self.nrows
+        meta['dtypes'] = self.dtypes
+        with open(os.path.join(self.temp_path, 'meta.json'), 'w') as output:
+            json.dump(meta, output)
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path, ignore_errors=True)
+        try:
+            os.rename(self.temp_path, self.path)
+        except OSError:
+            # another process cached the same file first
+            self.abort()
+        self.cache.evict()
+
+    def abort(self):
+        for f in self.files.values():
+            f.close()
+        shutil.rmtree(self.temp_path, ignore_errors=True)
@@ -2,39 +2,531 @@
 Classes for post-processing of PRMS animation data
 """
 import os
+import sys
+import itertools
+import threading
+import Queue
+import shutil
+import tempfile
+import multiprocessing
+from collections import deque
 import numpy as np
 import pandas as pd
 from functools import partial
 import datetime as dt
 import csv
-
-
-def check_finite(dataframe, file, errorfile, exclude_cols=[]):
-    """Identify any values in an array that are nans or +/- inf
+import mmap
+from io import BytesIO
+from PRMS_animation_profile import profiler
+from PRMS_animation_diagnostics import NonFiniteReport
+from PRMS_animation_store import file_labels
+from PRMS_animation_manifest import replace_file
+
+
+def check_finite(dataframe, file, errorfile, exclude_cols=[], report=None, values=None):
+    """Identify any values in an array that are nans or +/- inf (see PRMS_animation_diagnostics).
+    The number of each kind in each column, and the indices (hrus) with them, are written to errorfile,
+    and added to report (a NonFiniteReport), if supplied;
+    values (optional) describes the values checked in the error file (e.g. 'percent differences').
     """
-    nans = False
-    df = dataframe.drop(list(set(exclude_cols).intersection(set(dataframe.columns))), axis=1)
-    column_sums = np.sum(~np.isfinite(df))
-    if column_sums.sum() > 0:
-        nans = True
-        errorfile.write('{}:\n'.format(file))
-        errorfile.write('Number of non-finite by column:\n')
-        errorfile.write(column_sums.to_string())
-        errorfile.write('\nIndices of non-finite values:\n')
-        isnans = np.isnan(df)
-        inds = dict([(c, df.ix[isnans[c].values, c].index.tolist()) for c in df.columns])
-        for k, v in inds.iteritems():
-            if len(v) > 0:
-                errorfile.write('{}:'.format(k))
-                for i in v:
-                    errorfile.write(' {}'.format(i))
-                errorfile.write('\n')
-        errorfile.write('\n')
-    return nans
+    if report is None:
+        report = NonFiniteReport()
+    return report.check(dataframe, file, errorfile, exclude_cols=exclude_cols, values=values)
 
 def compute_timeseries_midpoint(timeseries):
     return timeseries[0] + (timeseries[-1] - timeseries[0])/2
 
+
+def prefetch_files(function, items, size=2, workers=None):
+    """Call a function on each of a list of items in background threads, keeping the results for
+    up to size items ready ahead of the one being used (e.g. to read the next animation files while
+    the current one is being processed). Results are returned in the same order as the items.
+
+    Parameters
+    ----------
+    function : callable
+        Function of one item (e.g. a file name)
+    items : list
+        Items to call function on
+    size : int
+        Maximum number of items whose results are held ahead of the current one
+    workers : int (optional)
+        Number of background threads; defaults to size
+
+    Returns
+    -------
+    A generator of (item, result) tuples; an exception raised by function is raised
+    again when its item is reached
+    """
+    if workers is None:
+        workers = size
+    tasks = Queue.Queue()
+    # set when the results are no longer wanted (e.g. after an error), so that queued items are skipped
+    stop = threading.Event()
+
+    class Task:
+        def __init__(self, item):
+            self.item = item
+            self.result = None
+            self.error = None
+            self.done = threading.Event()
+
+    def worker():
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            if stop.is_set():
+                continue
+            try:
+                task.result = function(task.item)
+            except Exception:
+                task.error = sys.exc_info()
+            task.done.set()
+
+    threads = [threading.Thread(target=worker) for i in range(max(1, workers))]
+    for thread in threads:
+        thread.start()
+
+    def submit(item):
+        task = Task(item)
+        tasks.put(task)
+        pending.append(task)
+
+    items = iter(items)
+    pending = deque()
+    try:
+        for item in itertools.islice(items, max(1, size)):
+            submit(item)
+        while len(pending) > 0:
+            task = pending.popleft()
+            while not task.done.wait(1):
+                # (waiting with a timeout, so that the main thread can still be interrupted)
+                pass
+            # start on the next item before handing over this one
+            for item in itertools.islice(items, 1):
+                submit(item)
+            if task.error is not None:
+                raise task.error[0], task.error[1], task.error[2]
+            yield task.item, task.result
+    finally:
+        # wait for any reads in progress to finish, so that no threads are left running
+        stop.set()
+        for thread in threads:
+            tasks.put(None)
+        for thread in threads:
+            thread.join()
+
+
+def timestamp_runs(values):
+    # start of each run of repeated values
+    # (the records for each timestamp are consecutive, one for each hru)
+    values = np.asarray(values)
+    if len(values) == 0:
+        return np.array([], dtype=int)
+    return np.flatnonzero(np.r_[True, values[1:] != values[:-1]])
+
+
+def decode_timestamps(strings):
+    """Convert animation file timestamps (YYYY-mm-dd:HH:MM:SS) to datetimes.
+    Each run of repeated timestamps is only decoded once, by slicing the digits out of
+    their fixed positions, and the result is repeated back out to every row.
+    Timestamps that don't fit the layout are left to pandas.
+
+    Parameters
+    ----------
+    strings : 1-D array
+        Timestamp strings, one for each row
+
+    Returns
+    -------
+    Array of datetime64[ns] values, one for each row
+    """
+    strings = np.asarray(strings)
+    starts = timestamp_runs(strings)
+    lengths = np.diff(np.r_[starts, len(strings)])
+    distinct = np.asarray(strings[starts], dtype=str)
+    width = len('YYYY-mm-dd:HH:MM:SS')
+    if len(distinct) == 0 or distinct.dtype.itemsize != width:
+        return np.repeat(pd.to_datetime(distinct, format='%Y-%m-%d:%H:%M:%S').values, lengths)
+
+    characters = distinct.view(np.uint8).reshape(-1, width)
+    separators = characters[:, [4, 7, 10, 13, 16]]
+    digits = np.delete(characters, [4, 7, 10, 13, 16], axis=1).astype(np.int64) - ord('0')
+    if np.any(separators != np.array([ord(c) for c in '--:::'], dtype=np.uint8)) or \
+            np.any((digits < 0) | (digits > 9)):
+        return np.repeat(pd.to_datetime(distinct, format='%Y-%m-%d:%H:%M:%S').values, lengths)
+
+    def field(first, last):
+        # integer value of the digits from first to last (positions with the separators removed)
+        return np.dot(digits[:, first:last], 10 ** np.arange(last - first - 1, -1, -1))
+    year, month, day = field(0, 4), field(4, 6), field(6, 8)
+    seconds = field(8, 10) * 3600 + field(10, 12) * 60 + field(12, 14)
+
+    months = (year - 1970).astype('datetime64[Y]').astype('datetime64[M]') + (month - 1).astype('timedelta64[M]')
+    days = months.astype('datetime64[D]') + (day - 1).astype('timedelta64[D]')
+    # out of range months or days (e.g. Feb 30) would roll over into the next month
+    if np.any((month < 1) | (month > 12) | (day < 1) | (days.astype('datetime64[M]') != months) |
+              (seconds >= 24 * 3600)):
+        return np.repeat(pd.to_datetime(distinct, format='%Y-%m-%d:%H:%M:%S').values, lengths)
+    values = days.astype('datetime64[ns]') + seconds.astype('timedelta64[s]')
+    return np.repeat(values, lengths)
+
+
+def calendar_codes(index):
+    """Return the year and month of each entry in a DatetimeIndex, as integer arrays.
+    These are only computed once for each run of repeated timestamps.
+    """
+    values = np.asarray(index.asi8)
+    starts = timestamp_runs(values)
+    lengths = np.diff(np.r_[starts, len(values)])
+    distinct = pd.DatetimeIndex(values[starts])
+    return np.repeat(np.asarray(distinct.year), lengths), np.repeat(np.asarray(distinct.month), lengths)
+
+
+def group_reduce(keys, values, stats):
+    """Grouped reductions with numpy, in a single pass over the rows.
+
+    Parameters
+    ----------
+    keys : list of 1-D arrays
+        Integer group labels for each row (e.g. year, month, hru number)
+    values : dict
+        Arrays of values for each column, one value per row
+    stats : dict
+        Reduction for each column ('sum', 'count', 'max' or 'min');
+        nans are skipped, as in pandas
+
+    Returns
+    -------
+    keys : list of arrays
+        Group labels for each group, sorted in the same order as a pandas groupby
+    results : dict
+        Reduced arrays for each column, one value per group
+    """
+    # convert the labels to dense integer codes, and combine them into one code per group
+    uniques, codes = zip(*[np.unique(k, return_inverse=True) for k in keys])
+    group_ids = np.ravel_multi_index(codes, [len(u) for u in uniques])
+    group_ids, groups = np.unique(group_ids, return_inverse=True)
+    ngroups = len(group_ids)
+    group_keys = [u[i] for u, i in zip(uniques, np.unravel_index(group_ids, [len(u) for u in uniques]))]
+
+    # sums and counts by bincount; maxima and minima by reduceat over the rows sorted by group
+    order, starts = None, None
+    results = {}
+    for c, stat in stats.iteritems():
+        v = np.asarray(values[c], dtype=float)
+        isfinite = ~np.isnan(v)
+        if stat == 'sum':
+            results[c] = np.bincount(groups, weights=np.where(isfinite, v, 0.), minlength=ngroups)
+        elif stat == 'count':
+            results[c] = np.bincount(groups, weights=isfinite, minlength=ngroups)
+        else:
+            if order is None:
+                order = np.argsort(groups, kind='mergesort')
+                starts = np.r_[0, np.flatnonzero(np.diff(groups[order])) + 1]
+            reduce = {'max': np.fmax, 'min': np.fmin}[stat]
+            results[c] = reduce.reduceat(v[order], starts)
+    return group_keys, results
+
+
+class GroupAggregator:
+    # computes grouped statistics with numpy reductions (see group_reduce),
+    # over one or more blocks of data, so that an animation file can also be
+    # aggregated without reading it all into memory
+    # only operations that can be built from sums, counts, maxima and minima are supported
+
+    # partial statistics needed for each operation, and how partials from different blocks are combined
+    partial_stats = {'sum': ['sum'], 'mean': ['sum', 'count'], 'count': ['count'], 'max': ['max'], 'min': ['min']}
+    combine = {'sum': 'sum', 'count': 'sum', 'max': 'max', 'min': 'min'}
+
+    def __init__(self, operations):
+        # operations: dictionary of column names and operations, e.g. Input.operations
+        self.operations = {}
+        for c, op in operations.iteritems():
+            op = self.operation(op)
+            if op not in self.partial_stats:
+                raise ValueError('Operation {} for {} is not supported by GroupAggregator; '
+                                 'supported operations are {}'.format(op, c, ', '.join(sorted(self.partial_stats))))
+            self.operations[c] = op
+        self.names = None
+        self.keys = None
+        self.stats = None
+        self.periods = None
+        self.complete = []
+        self.first = None
+        self.last = None
+
+    @staticmethod
+    def operation(op):
+        # operations in Input.operations are lists with a single entry
+        if not isinstance(op, basestring):
+            op = op[0]
+        return op
+
+    @classmethod
+    def supports(cls, operations):
+        """Return True if all of the operations can be computed by a GroupAggregator.
+        """
+        return np.all([cls.operation(op) in cls.partial_stats for op in operations.values()])
+
+    def update(self, df, keys, names, periods=None):
+        """Add a block of data to the running statistics.
+        Call finish() once all of the blocks have been added.
+
+        Parameters
+        ----------
+        df : dataframe
+            Block of an animation file, with a datetime index
+        keys : list of arrays
+            Integer group labels for each row of the block
+        names : list of str
+            Names for the group labels
+        periods : array (optional)
+            Integer time period for each row (e.g. year * 12 + month), if each group falls in a single period
+            and the blocks are in time order. Groups in periods before the last one in a block are then complete,
+            and are set aside, so that only the groups in the last period are merged with the next block.
+        """
+        if len(df) == 0:
+            return
+        if self.first is None:
+            self.first = df.index[0]
+        self.last = df.index[-1]
+        self.names = names
+
+        # (columns that are also group labels aren't reduced; see result)
+        columns = [c for c in self.operations.keys() if c in df.columns and c not in names]
+        stats = {}
+        values = {}
+        for c in columns:
+            for stat in self.partial_stats[self.operations[c]]:
+                stats[(stat, c)] = stat
+                values[(stat, c)] = df[c].values
+        keys = list(keys)
+        if periods is not None:
+            keys = [periods] + keys
+        keys, results = group_reduce(keys, values, stats)
+
+        if self.stats is not None:
+            # combine with the groups still open from previous blocks;
+            # groups that span a block boundary are merged here
+            open_keys = self.keys if self.periods is None else [self.periods] + self.keys
+            keys, results = self.merge_stats([open_keys, keys], [self.stats, results])
+
+        if periods is not None:
+            # (groups are sorted by period first)
+            periods, keys = keys[0], keys[1:]
+            complete = periods < periods[-1]
+            if complete.any():
+                self.complete.append(([k[complete] for k in keys],
+                                      dict([(k, v[complete]) for k, v in results.iteritems()])))
+                keys = [k[~complete] for k in keys]
+                results = dict([(k, v[~complete]) for k, v in results.iteritems()])
+                periods = periods[~complete]
+        self.periods = periods
+        self.keys = keys
+        self.stats = results
+
+    def merge_stats(self, keys, stats):
+        # combine lists of partial statistics for sets of groups, and their group labels
+        keys = [np.concatenate(k) for k in zip(*keys)]
+        values = dict([(k, np.concatenate([s[k] for s in stats])) for k in stats[0]])
+        return group_reduce(keys, values, dict([(k, self.combine[k[0]]) for k in values]))
+
+    def finish(self):
+        """Combine the complete groups set aside by update() with the open ones,
+        sorted in the same order as a pandas groupby.
+        """
+        if self.stats is not None and (self.periods is not None or len(self.complete) > 0):
+            self.keys, self.stats = self.merge_stats([k for k, s in self.complete] + [self.keys],
+                                                     [s for k, s in self.complete] + [self.stats])
+        self.complete = []
+        self.periods = None
+
+    def merge(self, other):
+        """Add the statistics from another GroupAggregator with the same operations and group labels
+        (e.g. for another part of the same file).
+        """
+        if other.stats is None:
+            return
+        self.finish()
+        other.finish()
+        if self.stats is None:
+            self.keys, self.stats = other.keys, other.stats
+        else:
+            self.keys, self.stats = self.merge_stats([self.keys, other.keys], [self.stats, other.stats])
+        self.names = other.names
+        self.first = other.first if self.first is None else min(self.first, other.first)
+        self.last = other.last if self.last is None else max(self.last, other.last)
+
+    def regroup(self, keys, names):
+        """Combine the statistics into coarser groups (e.g. months into years),
+        without going back to the data. The partial statistics (sums, counts, maxima and minima)
+        combine exactly, but the sums are added in a different order than when the data are aggregated
+        by the coarser groups directly, so sums and means can differ in the last digit
+        (as they do when the data are read in blocks).
+
+        Parameters
+        ----------
+        keys : list of arrays
+            New integer group labels for each of the current groups (see GroupAggregator.keys)
+        names : list of str
+            Names for the new group labels (including any columns that are group labels now, e.g. nhru)
+
+        Returns
+        -------
+        A new GroupAggregator
+        """
+        self.finish()
+        regrouped = GroupAggregator(self.operations)
+        regrouped.keys, regrouped.stats = self.merge_stats([keys], [self.stats])
+        regrouped.names = names
+        regrouped.first = self.first
+        regrouped.last = self.last
+        return regrouped
+
+    def result(self):
+        """Return a dataframe of the finished statistics, with one column per variable,
+        indexed by the group labels.
+        Columns that are also group labels (e.g. nhru) are taken from the labels, not reduced,
+        so that they keep their integer type, as in a pandas groupby.
+        """
+        self.finish()
+        if len(self.names) > 1:
+            index = pd.MultiIndex.from_arrays(self.keys, names=self.names)
+        else:
+            index = pd.Index(self.keys[0], name=self.names[0])
+        results = {}
+        for c, op in self.operations.iteritems():
+            if c in self.names:
+                results[c] = self.keys[self.names.index(c)]
+            elif op == 'mean':
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    results[c] = self.stats[('sum', c)] / self.stats[('count', c)]
+            elif op == 'count':
+                results[c] = self.stats[('count', c)].astype(int)
+            else:
+                results[c] = self.stats[(op, c)]
+        return pd.DataFrame(results, index=index)
+
+
+def column_files(ani_file, columns):
+    """Return raw binary files for the timestamps, hru numbers and other columns of an animation file,
+    so that they can be memory-mapped by other processes (see sharded_aggregate). Files in the cache are used
+    as they are; otherwise the data (or just the date window) are written to a temporary folder, block by block.
+
+    Returns
+    -------
+    files : dict
+        (file name, dtype) for each column; the timestamps are nanoseconds under the key 'timestamp'
+    rows : tuple
+        First and last (exclusive) rows of the data in the files
+    tempdir : str
+        Temporary folder with the files (to be removed afterwards), or None for cached files
+    """
+    if ani_file.cached:
+        meta = ani_file.cache.read_metadata(ani_file.infile)
+        path = ani_file.cache.entry_path(ani_file.infile)
+        files = dict([(c, (os.path.join(path, '{}.bin'.format(c)), str(meta['dtypes'][c])))
+                      for c in columns + ['nhru']])
+        files['timestamp'] = (os.path.join(path, '{}.bin'.format(ani_file.timestamp_column)), 'int64')
+        rows = ani_file.cache.window(ani_file, ani_file.cache.columns(ani_file), ani_file.start, ani_file.end)
+        return files, rows, None
+
+    tempdir = tempfile.mkdtemp(prefix='prms_shards_')
+    files = {}
+    nrows = 0
+    outputs = {}
+    if ani_file.chunksize is None:
+        chunks = [ani_file.df]
+    else:
+        chunks = ani_file.iter_chunks()
+    for chunk in chunks:
+        values = dict([(c, chunk[c].values) for c in columns + ['nhru']])
+        values['timestamp'] = np.asarray(chunk.index.asi8)
+        for c, v in values.iteritems():
+            if c not in files:
+                files[c] = (os.path.join(tempdir, '{}.bin'.format(c)), v.dtype.str)
+                outputs[c] = open(files[c][0], 'wb')
+            v.tofile(outputs[c])
+        nrows += len(chunk)
+    for f in outputs.values():
+        f.close()
+    return files, (0, nrows), tempdir
+
+
+def _aggregate_shard(args):
+    # aggregate the rows for a range of hru numbers (lower <= nhru < upper),
+    # from memory-mapped column files (see sharded_aggregate)
+    files, rows, operations, by, water_years, hru_range = args
+    columns = dict([(c, np.memmap(f, dtype=dtype, mode='r')[rows[0]:rows[1]]) for c, (f, dtype) in files.items()])
+    shard = np.flatnonzero((columns['nhru'] >= hru_range[0]) & (columns['nhru'] < hru_range[1]))
+    timestamps = pd.DatetimeIndex(columns['timestamp'][shard].view('datetime64[ns]'))
+    df = pd.DataFrame(dict([(c, columns[c][shard]) for c in files if c != 'timestamp']), index=timestamps)
+
+    years, months = calendar_codes(timestamps)
+    if water_years:
+        years = years + (months >= 10)
+    keys = {'month': months, 'year': years, 'nhru': df['nhru'].values}
+    aggregator = GroupAggregator(operations)
+    aggregator.update(df, [keys[k] for k in by], by)
+    return aggregator
+
+
+def sharded_aggregate(ani_file, operations, by, shards, water_years=False):
+    """Grouped statistics for an animation file (as from PeriodStatistics.aggregate), with the hrus split
+    into ranges that are aggregated in separate processes. The data are passed to the processes as
+    memory-mapped column files (see column_files), rather than being copied, and the statistics for each range
+    are merged back together in hru order. All of the groupings include the hru, so the results are the same
+    as aggregating the whole file at once.
+
+    Parameters
+    ----------
+    ani_file : AnimationFile
+    operations : dict
+        Operations for each column (as for GroupAggregator)
+    by : list of str
+        Group labels, from 'month', 'year' and 'nhru' (must include 'nhru')
+    shards : int
+        Number of hru ranges (and processes)
+    water_years : T/F
+        If the data are in water years (start in October), count October-December toward the following year
+
+    Returns
+    -------
+    aggregator : GroupAggregator
+    in_water_years : T/F
+        Whether the data are in water years
+    """
+    columns = [c for c in operations if c in ani_file.usecols and c not in ['nhru', ani_file.timestamp_column]]
+    files, rows, tempdir = column_files(ani_file, columns)
+    aggregator = GroupAggregator(operations)
+    in_water_years = False
+    try:
+        if rows[1] <= rows[0]:
+            return aggregator, in_water_years
+        timestamps = np.memmap(files['timestamp'][0], dtype=files['timestamp'][1], mode='r')[rows[0]:rows[1]]
+        in_water_years = pd.Timestamp(timestamps[min(1, len(timestamps) - 1)]).month == 10
+        nhru = np.memmap(files['nhru'][0], dtype=files['nhru'][1], mode='r')[rows[0]:rows[1]]
+        bounds = np.linspace(nhru.min(), nhru.max() + 1, shards + 1)
+        del timestamps, nhru
+
+        tasks = [(files, rows, operations, by, water_years and in_water_years, (bounds[i], bounds[i+1]))
+                 for i in range(shards)]
+        with profiler.stage('groupby', ani_file.infile, rows[1] - rows[0]):
+            pool = multiprocessing.Pool(shards)
+            try:
+                for shard in pool.imap(_aggregate_shard, tasks):
+                    aggregator.merge(shard)
+            finally:
+                pool.close()
+                pool.join()
+    finally:
+        if tempdir is not None:
+            shutil.rmtree(tempdir, ignore_errors=True)
+    return aggregator, in_water_years
+
+
 class Input:
     # this class parses the Input file, which contains information on
     # - path to the raw PRMS output
@@ -72,43 +564,407 @@ class Input:
 # object containing information on the PRMS animation file
 class AnimationFile:
     
-    def __init__(self, infile):
-        
+    def __init__(self, infile, chunksize=None, cache=None, start=None, end=None, nyears=None,
+                 columns=None, float32=False, lazy=False):
+        # chunksize (optional): number of rows to read at a time. If given, the header is parsed
+        # but the data are not read into self.df; use iter_chunks() to stream through them instead
+        # cache (optional): AnimationCache instance; if the file has been cached (and hasn't changed since),
+        # it is read from the cache instead of being parsed; otherwise it is added to the cache as it is read
+        # start, end (optional): only read records within this date window (inclusive)
+        # nyears (optional): only read the last nyears of records (starting January 1; overrides start)
+        # date windows are located with an index of byte offsets (see offset_index), so only the window is parsed
+        # columns (optional): only read these columns (e.g. the keys of Input.operations), plus nhru
+        # float32 (T/F): keep the state variables as 32-bit floats (statistics are still accumulated in 64 bits)
+        # with either option, the data are loaded compactly: nhru is stored as a 32-bit integer,
+        # and the timestamps are only kept as the index (not also as a column);
+        # with a cache, files that aren't cached yet are parsed in full and added to the cache,
+        # then reduced to the compact layout (see compact_frame)
+        # lazy (T/F): only parse the header; the data are read the first time self.df is used
+        # (e.g. for a quick inventory of a batch of files; see inventory)
+
         self.delimiter = None 
         self.infile = infile
         self.header = []
         self.header_row = 0
+        self.chunksize = chunksize
+        self.cache = cache
+        self.cached = False
+        # (the dates can be strings or datetimes; they are compared with the record timestamps)
+        self.start = None if start is None else pd.Timestamp(start)
+        self.end = None if end is None else pd.Timestamp(end)
+        self.columns = columns
+        self.float32 = float32
+        self.compact = columns is not None or float32
 
         self.column_names = None
         self.formats_line = None
-        self.df = pd.DataFrame()
-        
-        # get header info
-        try:
-            indata = open(infile).readlines()[0:100]
-        except:
-            raise(InputFileError(infile))
-            
-        # get delimiter
-        dialect = csv.Sniffer().sniff(indata[-2])
-        self.delimiter= dialect.delimiter
-        
-        # get header info
-        for line in indata:
-            if line.split(self.delimiter)[0]=='timestamp':
-                break
-            else:
-                self.header.append(line.strip())
-                self.header_row += 1
-        self.column_names = indata[self.header_row].strip().split(self.delimiter)
-        self.timestamp_column = self.column_names[0]
-        self.formats_line = indata[self.header_row+1]
+        self.lazy = lazy
+        if not lazy:
+            self.df = pd.DataFrame()
+
+        if cache is not None:
+            self.cached = cache.read_header(self)
+
+        if not self.cached:
+            with profiler.stage('header', infile):
+                # get header info
+                # (only the first 100 lines are read, not the whole file)
+                try:
+                    with open(infile) as input_file:
+                        indata = list(itertools.islice(input_file, 100))
+                except:
+                    raise(InputFileError(infile))
+
+                # get delimiter
+                dialect = csv.Sniffer().sniff(indata[-2])
+                self.delimiter= dialect.delimiter
+
+                # get header info
+                for line in indata:
+                    if line.split(self.delimiter)[0]=='timestamp':
+                        break
+                    else:
+                        self.header.append(line.strip())
+                        self.header_row += 1
+                self.column_names = indata[self.header_row].strip().split(self.delimiter)
+                self.timestamp_column = self.column_names[0]
+                self.formats_line = indata[self.header_row+1]
+
+        # columns to load
+        self.usecols = self.column_names
+        if columns is not None:
+            self.usecols = [c for c in self.column_names
+                            if c in columns or c in [self.timestamp_column, 'nhru']]
+
+        if nyears is not None:
+            self.start = pd.Timestamp(dt.datetime(self.last_timestamp().year - nyears, 1, 1))
         
         # read animation file into pandas dataframe
+        if self.chunksize is None and not lazy:
+            self.df = self.load()
+
+    def __getattr__(self, name):
+        # only called for attributes that haven't been set; in lazy mode, the data are read on first use
+        if name == 'df' and self.__dict__.get('lazy') and self.__dict__.get('chunksize') is None:
+            self.df = self.load()
+            return self.df
+        raise AttributeError(name)
+
+    def load(self):
+        """Read the records in the date window (if there is one) into a dataframe,
+        from the cache if the file is cached, otherwise by parsing the file (adding it to the cache).
+        """
+        if self.cached:
+            print "reading {0:s} from cache...".format(self.infile)
+            with profiler.stage('read_cache', self.infile) as stage:
+                df = self.compact_frame(self.cache.read(self, start=self.start, end=self.end))
+                stage.rows = len(df)
+            return df
+        elif self.start is not None or self.end is not None:
+            print "reading {0:s} from {1} to {2}...".format(self.infile, self.start, self.end)
+            return self.read_window(self.start, self.end)
+
         print "reading {0:s}...".format(self.infile)
-        self.df = pd.read_csv(self.infile, sep=self.delimiter, header=self.header_row, skiprows=[self.header_row+1])
-        self.df[self.timestamp_column] = pd.to_datetime(self.df[self.timestamp_column], format='%Y-%m-%d:%H:%M:%S')
-        self.df.index = pd.to_datetime(self.df[self.column_names[0]], format='%Y-%m-%d:%H:%M:%S')
+        # (the cache holds all of the columns, so they are all parsed if the file is being cached)
+        caching = self.cache is not None
+        with profiler.stage('read_csv', self.infile) as stage:
+            df = pd.read_csv(self.infile, sep=self.delimiter, header=self.header_row,
+                             skiprows=[self.header_row+1], **self.read_options(all_columns=caching))
+            stage.rows = len(df)
+        df = self.parse_timestamps(df, all_columns=caching)
+        if caching:
+            with profiler.stage('write_cache', self.infile, len(df)):
+                self.cache.write(self, df)
+            df = self.compact_frame(df)
+        return df
+
+    def parse_timestamps(self, df, all_columns=False):
+        """Convert the timestamp column of a dataframe read from the animation file to datetimes,
+        and use it as the index. The timestamps are only parsed once.
+        With all_columns, the timestamp column is kept even if the file is loaded compactly (e.g. for the cache).
+        """
+        with profiler.stage('parse_timestamps', self.infile, len(df)):
+            timestamps = pd.DatetimeIndex(decode_timestamps(df[self.timestamp_column].values),
+                                          name=self.timestamp_column)
+            df[self.timestamp_column] = timestamps.values
+            df.index = timestamps
+            if self.compact and not all_columns:
+                del df[self.timestamp_column]
+        return df
+
+    def read_options(self, all_columns=False):
+        # keyword arguments for read_csv, to only parse the columns that are needed, into compact types
+        # all_columns (T/F): parse all of the columns, with their default types (e.g. for the cache)
+        if not self.compact or all_columns:
+            return {}
+        dtypes = {'nhru': np.int32}
+        if self.float32:
+            for c in self.usecols:
+                if c not in [self.timestamp_column, 'nhru']:
+                    dtypes[c] = np.float32
+        return {'usecols': self.usecols, 'dtype': dtypes}
+
+    def compact_frame(self, df):
+        # reduce a dataframe laid out like AnimationFile.df (e.g. from the cache) to the columns and types
+        # that would have been read with read_options()
+        if not self.compact:
+            return df
+        df = df[[c for c in self.usecols if c != self.timestamp_column]]
+        dtypes = dict([(c, np.float32) for c in df.columns if self.float32 and c != 'nhru'])
+        dtypes['nhru'] = np.int32
+        return df.astype(dtypes, copy=False)
+
+    def iter_chunks(self, chunksize=None):
+        """Read the animation file in blocks of rows, so that the whole file never has to be in memory.
+
+        Parameters
+        ----------
+        chunksize : int (optional)
+            Number of rows per block; defaults to the chunksize the AnimationFile was created with.
+
+        Returns
+        -------
+        A generator of dataframes, each laid out like AnimationFile.df
+        """
+        if chunksize is None:
+            chunksize = self.chunksize
+        if chunksize is None:
+            raise ValueError('A chunksize is needed to read {} in blocks.'.format(self.infile))
+        print "reading {0:s} in blocks of {1:d} rows...".format(self.infile, chunksize)
+        if self.cached:
+            reader = (self.compact_frame(chunk)
+                      for chunk in self.cache.iter_chunks(self, chunksize, start=self.start, end=self.end))
+        else:
+            reader = self.read_csv_chunks(chunksize)
+        for chunk in reader:
+            if self.start is not None:
+                chunk = chunk[chunk.index >= self.start]
+            if self.end is not None:
+                if chunk.index[0] > self.end:
+                    break
+                chunk = chunk[chunk.index <= self.end]
+            if len(chunk) == 0:
+                continue
+            yield chunk
+
+    def read_csv_chunks(self, chunksize):
+        # parse the animation file in blocks of rows, adding each block to the cache (if there is one)
+        # without a cache, reading starts at the first record of the date window (if there is one)
+        writer = None
+        if self.cache is not None:
+            writer = self.cache.writer(self)
+        caching = writer is not None
+        input_file = None
+        if writer is None and self.start is not None:
+            timestamps, offsets = self.offset_index()
+            input_file = open(self.infile, 'rb')
+            input_file.seek(self.window_offsets(timestamps, offsets, self.start, None)[0])
+            reader = pd.read_csv(input_file, sep=self.delimiter, header=None, names=self.column_names,
+                                 chunksize=chunksize, **self.read_options())
+        else:
+            reader = pd.read_csv(self.infile, sep=self.delimiter, header=self.header_row,
+                                 skiprows=[self.header_row+1], chunksize=chunksize,
+                                 **self.read_options(all_columns=caching))
+        reader = iter(reader)
+        try:
+            while True:
+                with profiler.stage('read_csv', self.infile) as stage:
+                    try:
+                        chunk = next(reader)
+                    except StopIteration:
+                        break
+                    stage.rows = len(chunk)
+                chunk = self.parse_timestamps(chunk, all_columns=caching)
+                if writer is not None:
+                    writer.append(chunk)
+                    chunk = self.compact_frame(chunk)
+                yield chunk
+        except GeneratorExit:
+            # file wasn't read to the end; don't cache it
+            if writer is not None:
+                writer.abort()
+            raise
+        finally:
+            if input_file is not None:
+                input_file.close()
+        if writer is not None:
+            writer.close()
+
+    def offset_index(self):
+        """Return the byte offset of the first record for each timestamp in the animation file.
+        The index is built in one pass through the file, and saved next to it (as <infile>.offsets.npz),
+        to be reused until the file changes.
+
+        Returns
+        -------
+        timestamps : DatetimeIndex
+            Distinct timestamps in the file
+        offsets : array
+            Byte offset of the first record with each timestamp
+        """
+        indexfile = '{}.offsets.npz'.format(self.infile)
+        stat = os.stat(self.infile)
+        if os.path.isfile(indexfile):
+            with np.load(indexfile) as index:
+                if index['mtime'] == stat.st_mtime and index['size'] == stat.st_size:
+                    return pd.DatetimeIndex(index['timestamps']), index['offsets']
+
+        print "indexing {0:s}...".format(self.infile)
+        timestamps, offsets = self.build_offset_index()
+        # write to a temporary file first, so that another process never reads a partial index
+        # (a stale index is replaced; see replace_file)
+        tempfile = '{}.{}.tmp'.format(indexfile, os.getpid())
+        try:
+            with open(tempfile, 'wb') as output:
+                np.savez(output, timestamps=timestamps.values, offsets=offsets,
+                         mtime=stat.st_mtime, size=stat.st_size)
+            replace_file(tempfile, indexfile)
+        except (IOError, OSError):
+            # folder isn't writable; the index is only used for this run
+            if os.path.isfile(tempfile):
+                os.remove(tempfile)
+        return timestamps, offsets
+
+    def build_offset_index(self, block_size=2**26):
+        # scan the file in blocks for line starts, and record where the timestamp changes
+        # (records for a timestamp are consecutive, one for each hru)
+        with open(self.infile, 'rb') as input_file:
+            data_start = sum([len(input_file.readline()) for i in range(self.header_row + 2)])
+        data = np.memmap(self.infile, dtype=np.uint8, mode='r')
+        width = len('YYYY-mm-dd:HH:MM:SS')
+        timestamps, offsets = [], []
+        previous = None
+        for block_start in range(data_start, len(data), block_size):
+            block = data[block_start:block_start + block_size]
+            starts = np.flatnonzero(block == ord('\n')) + block_start + 1
+            if block_start == data_start:
+                starts = np.r_[data_start, starts]
+            starts = starts[starts + width <= len(data)]
+            if len(starts) == 0:
+                continue
+            stamps = data[starts[:, np.newaxis] + np.arange(width)].view('S{}'.format(width)).ravel()
+            changed = np.r_[stamps[0] != previous, stamps[1:] != stamps[:-1]]
+            timestamps.append(stamps[changed])
+            offsets.append(starts[changed])
+            previous = stamps[-1]
+        del data
+        if len(timestamps) == 0:
+            return pd.DatetimeIndex([]), np.array([], dtype=np.int64)
+        timestamps = pd.DatetimeIndex(decode_timestamps(np.concatenate(timestamps)))
+        return timestamps, np.concatenate(offsets).astype(np.int64)
+
+    def window_offsets(self, timestamps, offsets, start=None, end=None):
+        # byte range of the records from start to end (inclusive)
+        size = os.path.getsize(self.infile)
+        first, last = 0, len(offsets)
+        if start is not None:
+            first = timestamps.searchsorted(pd.Timestamp(start), side='left')
+        if end is not None:
+            last = timestamps.searchsorted(pd.Timestamp(end), side='right')
+        begin = offsets[first] if first < len(offsets) else size
+        stop = offsets[last] if last < len(offsets) else size
+        return begin, stop
+
+    def read_window(self, start=None, end=None):
+        """Read only the records between two dates (inclusive) into a dataframe laid out like AnimationFile.df.
+        The window is located with the offset index, and read from the memory-mapped file.
+        """
+        begin, stop = self.window_offsets(*self.offset_index(), start=start, end=end)
+        if stop <= begin:
+            # no records in the window; read the first record, to get the column types
+            return self.parse_timestamps(pd.read_csv(self.infile, sep=self.delimiter, header=self.header_row,
+                                                     skiprows=[self.header_row+1], nrows=1,
+                                                     **self.read_options()).iloc[:0])
+        with profiler.stage('read_csv', self.infile) as stage:
+            with open(self.infile, 'rb') as input_file:
+                data = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+                window = data[begin:stop]
+                data.close()
+            df = pd.read_csv(BytesIO(window), sep=self.delimiter, header=None, names=self.column_names,
+                             **self.read_options())
+            stage.rows = len(df)
+        return self.parse_timestamps(df)
+
+    def last_timestamp(self):
+        """Return the timestamp of the last record, read by seeking to the end of the file.
+        """
+        with open(self.infile, 'rb') as input_file:
+            input_file.seek(0, os.SEEK_END)
+            position = input_file.tell()
+            lines = []
+            while position > 0 and len(lines) < 2:
+                position = max(0, position - 4096)
+                input_file.seek(position)
+                lines = input_file.read().strip().splitlines()
+        return pd.to_datetime(lines[-1].split(self.delimiter)[0], format='%Y-%m-%d:%H:%M:%S')
+
+    def first_records(self, nrecords=None):
+        # records with the first timestamp (one for each hru; or only the first nrecords),
+        # read line by line after the header
+        with open(self.infile, 'rb') as input_file:
+            for i in range(self.header_row + 2):
+                input_file.readline()
+            first = input_file.readline()
+            timestamp = first.split(self.delimiter, 1)[0]
+            records = [first]
+            for line in input_file:
+                if line.split(self.delimiter, 1)[0] != timestamp or len(records) == nrecords:
+                    break
+                records.append(line)
+        return records
+
+    def first_timestamp(self):
+        """Return the timestamp of the first record, read from the line after the header.
+        """
+        return pd.to_datetime(self.first_records(1)[0].split(self.delimiter)[0], format='%Y-%m-%d:%H:%M:%S')
+
+    def inventory(self):
+        """Summarize the layout of the animation file without reading its data:
+        the date range is read from the first and last records, and the number of hrus is
+        the number of records with the first timestamp.
+
+        Returns
+        -------
+        A dictionary with the file name, size (bytes), delimiter, column names, number of hrus,
+        and first and last timestamps
+        """
+        records = self.first_records()
+        return {'file': self.infile, 'size': os.path.getsize(self.infile), 'delimiter': self.delimiter,
+                'columns': self.column_names, 'nhru': len(records),
+                'start': pd.to_datetime(records[0].split(self.delimiter)[0], format='%Y-%m-%d:%H:%M:%S'),
+                'end': self.last_timestamp()}
+
+    def hru_means(self, shards=None):
+        """Computes mean values for each hru, for each column (state variable),
+        and sets dt_midpoint. Files opened with a chunksize are read in blocks.
+        With shards, the hrus are split among that many processes (see sharded_aggregate).
+
+        Returns
+        -------
+        A dataframe of mean values for each hru (rows), for each state variable (columns)
+        """
+        if self.chunksize is None and not self.float32 and shards is None:
+            self.dt_midpoint = compute_timeseries_midpoint(self.df.index)
+            with profiler.stage('groupby', self.infile, len(self.df)):
+                return self.df.groupby('nhru').mean()
+
+        # (32-bit values are also summed with GroupAggregator, which accumulates in 64 bits)
+        columns = [c for c in self.usecols if c not in [self.timestamp_column, 'nhru']]
+        if shards is not None:
+            aggregator = sharded_aggregate(self, dict([(c, 'mean') for c in columns]), ['nhru'], shards)[0]
+            self.dt_midpoint = compute_timeseries_midpoint([aggregator.first, aggregator.last])
+            return aggregator.result()[columns]
+
+        aggregator = GroupAggregator(dict([(c, 'mean') for c in columns]))
+        if self.chunksize is None:
+            chunks = [self.df]
+        else:
+            chunks = self.iter_chunks()
+        for chunk in chunks:
+            with profiler.stage('groupby', self.infile, len(chunk)):
+                aggregator.update(chunk, [chunk['nhru'].values], ['nhru'])
+        self.dt_midpoint = compute_timeseries_midpoint([aggregator.first, aggregator.last])
+        return aggregator.result()[columns]
 
     def parse_header(self):
         fmt = {}
@@ -151,8 +1007,45 @@ class AnimationFile:
                 continue
         self.fmts = fmt
 
+        # equivalent %-style format strings, for formatting whole columns at once (see format_columns)
+        # datetime columns are None
+        self.column_formats = {}
+        for variable, f in fmt.iteritems():
+            if f.func is fmt_col:
+                column_width, precision, type = f.args
+                if type.lower() == 'e':
+                    column_width -= 1
+                self.column_formats[variable] = '%{}.{}{}\t'.format(column_width, precision, type)
+            else:
+                self.column_formats[variable] = None
+
+    def format_columns(self, df):
+        """Format each column of a dataframe as a whole, using the column formats in the header.
+        The result is laid out the same as df.to_string(header=False, index=False, formatters=self.fmts):
+        each column is right-justified to its widest entry, and columns are separated by a space.
 
-    def write_output(self, dataframe, outfile, timestamp=None):
+        Returns
+        -------
+        An array of strings, one for each row of df
+        """
+        lines = None
+        for c in df.columns:
+            values = df[c].values
+            if self.column_formats[c] is None:
+                # format each distinct timestamp only once
+                timestamps, inverse = np.unique(values, return_inverse=True)
+                strings = np.array(pd.DatetimeIndex(timestamps).strftime('%Y-%m-%d:%H:%M:%S'), dtype=str)[inverse]
+            else:
+                strings = np.char.mod(self.column_formats[c], values)
+            strings = np.char.rjust(strings, np.char.str_len(strings).max())
+            if lines is None:
+                lines = strings
+            else:
+                lines = np.char.add(np.char.add(lines, ' '), strings)
+        return lines
+
+
+    def write_output(self, dataframe, outfile, timestamp=None, block_size=100000):
 
         print 'writing {}...'.format(outfile)
         df = dataframe.copy()
@@ -160,7 +1053,7 @@ class AnimationFile:
             # put index in as a column otherwise won't print properly
             df.insert(0, df.index.name, df.index.values)
         if timestamp is not None:
-            df.insert(0, 'timestamp', [pd.Timestamp(timestamp)] * len(df))
+            df.insert(0, 'timestamp', np.repeat(pd.Timestamp(timestamp).to_datetime64(), len(df)))
 
         self.parse_header()
 
@@ -182,11 +1075,16 @@ class AnimationFile:
         formats_line = [f for i, f in enumerate(formats_line) if self.column_names[i] in df.columns]
         ofp.write('\t'.join(formats_line) + '\n')
 
-        # make list of output formatters consistent with dataframe columns
-        formatters = [self.fmts[c] for c in df.columns]
-
         # now write the damn dataframe!
-        ofp.write(df.to_string(header=False, index=False, formatters=formatters))
+        # (formatted a column at a time, and written in blocks of rows)
+        if len(df) > 0:
+            with profiler.stage('format_output', self.infile, len(df)):
+                lines = self.format_columns(df)
+            with profiler.stage('write_output', self.infile, len(df)):
+                for start in range(0, len(lines), block_size):
+                    if start > 0:
+                        ofp.write('\n')
+                    ofp.write('\n'.join(lines[start:start + block_size].tolist()))
         ofp.close()
 
 
@@ -194,92 +1092,64 @@ class AnimationFile:
 
 class hruStatistics:
 
-    def __init__(self, period_files, baseline_file=None, nyears=None, error_file='hruStatistics_errors.txt'):
+    def __init__(self, period_files, baseline_file=None, nyears=None, error_file='hruStatistics_errors.txt',
+                 chunksize=None, cache=None, prefetch=None, shards=None, max_indices=None):
+        # prefetch (optional): number of animation files to read at once, in background threads
+        # shards (optional): number of processes to split the hrus of each file among, for the means
+        # max_indices (optional): number of hrus to list for each kind of non-finite value in each column
+        # (non-finite values found are also collected in self.nonfinite; see NonFiniteReport.write)
 
         self.period_files = period_files
         self.baseline_file = baseline_file
+        self.chunksize = chunksize
+        self.shards = shards
         self.period = None
         self.periods = {}
+
+        infiles = period_files if isinstance(period_files, list) else [period_files]
+        if baseline_file is not None:
+            infiles = infiles + [baseline_file]
+        read = partial(AnimationFile, chunksize=chunksize, cache=cache, nyears=nyears)
+        if prefetch is not None:
+            ani_files = dict(prefetch_files(read, infiles, size=prefetch))
+        else:
+            ani_files = dict([(f, read(f)) for f in infiles])
+
         if isinstance(period_files, list):
             for pf in period_files:
-                self.periods[pf] = AnimationFile(pf)
+                self.periods[pf] = ani_files[pf]
         else:
-            self.period = AnimationFile(period_files)
+            self.period = ani_files[period_files]
 
         if baseline_file is not None:
-            self.baseline = AnimationFile(baseline_file)
+            self.baseline = ani_files[baseline_file]
 
         self.nyears = nyears
         self.nans = False
+        self.nonfinite = NonFiniteReport(max_indices)
         self.error_file = open(error_file, 'w')
 
         self.trim_to_last_nyears()
 
     def trim_to_last_nyears(self):
 
-        for pf, period in self.periods.iteritems():
-            if self.nyears is not None:
-                startyear = period.df.index[-1].year - self.nyears
-                self.periods[pf].df = period.df.ix[dt.datetime(startyear, 1, 1):].copy()
-            self.periods[pf].dt_midpoint = compute_timeseries_midpoint(self.periods[pf].df.index)
-
-        if self.period is not None:
-            if self.nyears is not None:
-                startyear = self.period.df.index[-1].year - self.nyears
-                self.period.df = self.period.df.ix[dt.datetime(startyear, 1, 1):].copy()
-            self.period.dt_midpoint = compute_timeseries_midpoint(self.period.df.index)
-
-        if self.baseline_file is not None:
-            if self.nyears is not None:
-                startyear = self.baseline.df.index[-1].year - self.nyears
-                self.baseline.df = self.baseline.df.ix[dt.datetime(startyear, 1, 1):].copy()
-            self.baseline.dt_midpoint = compute_timeseries_midpoint(self.baseline.df.index)
-    '''
-    def hru_mean(self, dataframe, timestamp_column=None):
-        """Computes mean values for each hru, for each column (state variable)
-
-        Parameters
-        ----------
-        dataframe : dataframe
-            Dataframe with datetime index, a column named 'nhru' with PRMS hru number,
-            and additional columns of PRMS state variables
+        # the animation files only read their last nyears of data (see AnimationFile),
+        # so only the midpoints are needed here
+        # (for files read in blocks, these are computed along with the means)
+        for ani_file in self.periods.values() + [self.period, getattr(self, 'baseline', None)]:
+            if ani_file is not None and ani_file.chunksize is None:
+                ani_file.dt_midpoint = compute_timeseries_midpoint(ani_file.df.index)
 
-        nyears : int (optional)
-            Compute mean for last nyears of period.
-            (e.g. for neglecting a period of model "spin-up"
-
-        Returns
-        -------
-        A dataframe of mean values for each hru (rows), for each state variable (columns)
+    def hru_mean(self, ani_file):
+        """Computes mean values for each hru, for each column (state variable)
+        (see AnimationFile.hru_means)
         """
+        return ani_file.hru_means(shards=self.shards)
 
-        if self.nyears is not None:
-            startyear = dataframe.index[-1].year - self.nyears
-            df = dataframe.ix[dt.datetime(startyear, 1, 1):].copy()
-            print df.index
-        else:
-
-        df = dataframe.copy()
-        
-        dfg = df.groupby('nhru').mean()
-        
-        # Kludge! to restore datetime column that is dropped by pandas in groupby above
-        # a waste of space (and effort), but CIDA's programs require it
-        # as add hru index as a column after timestamp
-        if timestamp_column is not None:
-            dt_midpoint = df.index[0] + (df.index[-1] - df.index[0])/2
-            dfg[timestamp_column] = dt_midpoint
-            dfg[dfg.index.name] = dfg.index
-            cols = list(dfg.columns)
-            cols.remove(timestamp_column)
-            cols = [timestamp_column, dfg.index.name] + cols
-            dfg = dfg[cols]
-            
-        return dfg
-    '''
     def hru_mean_pct_diff(self):
         """Computes percent differences in the state variable means for each hru.
-        Mean values are computed for the baseline_df and period_df using the hru_mean method.
+        Mean values are computed for the baseline_df and period_df using the hru_mean method;
+        files opened with a chunksize are aggregated block by block.
 
         Parameters
         ----------
@@ -301,72 +1171,217 @@ class hruStatistics:
         -------
         A dataframe of percent differences for each hru (rows), for each state variable (columns)
         """
-        #bl_mean = self.hru_mean(self.baseline.df)
-        bl_mean = self.baseline.df.groupby('nhru').mean()
+        bl_mean = self.hru_mean(self.baseline)
         self.baseline.means = bl_mean
 
         # if a list of period files was supplied, process all of the dataframes
         if len(self.periods) > 0:
             for pf, period in self.periods.iteritems():
-                #per_mean = self.hru_mean(period.df)
-                per_mean = period.df.groupby('nhru').mean()
-                self.periods[pf].pct_diff = 100 * (per_mean - bl_mean) / bl_mean
+                per_mean = self.hru_mean(period)
+                with profiler.stage('pct_diff', pf, len(per_mean)):
+                    self.periods[pf].pct_diff = 100 * (per_mean - bl_mean) / bl_mean
                 self.periods[pf].means = per_mean
-                self.nans = check_finite(self.periods[pf].pct_diff,
-                                         '{}\n(in percent differences)'.format(pf), self.error_file,
-                                         exclude_cols=period.timestamp_column)
+                with profiler.stage('check_finite', pf, len(per_mean)):
+                    self.nans = check_finite(self.periods[pf].pct_diff, pf, self.error_file,
+                                             exclude_cols=period.timestamp_column, report=self.nonfinite,
+                                             values='percent differences')
 
         # otherwise process the single dataframe
         else:
-            #per_mean = self.hru_mean(self.period.df)
-            per_mean = self.period.df.groupby('nhru').mean()
-            self.period.pct_diff = 100 * (per_mean - bl_mean) / bl_mean
+            per_mean = self.hru_mean(self.period)
+            with profiler.stage('pct_diff', self.period_files, len(per_mean)):
+                self.period.pct_diff = 100 * (per_mean - bl_mean) / bl_mean
             self.period.means = per_mean
-            self.nans = check_finite(self.period.pct_diff,
-                                     '{}\n(in percent differences)'.format(self.period_files), self.error_file)
+            with profiler.stage('check_finite', self.period_files, len(per_mean)):
+                self.nans = check_finite(self.period.pct_diff, self.period_files, self.error_file,
+                                         report=self.nonfinite, values='percent differences')
 
         if self.nans:
             print 'Warning, nan values found in percent differences. See error_file.'
         self.error_file.close()
 
-    def write_output(self, outdir):
+    def write_output(self, outdir, store=None):
+        # self.outfiles records the output files written for each input file
+        # store (optional): ResultStore to also add the means and percent differences to
+        # (labelled by the scenario, period and month in the file names; see PRMS_animation_store)
 
         for dir in [outdir, outdir + '/hru_means', outdir + '/hru_pct_diff']:
             if not os.path.isdir(dir):
                 os.makedirs(dir)
+        self.outfiles = {}
 
         baseline_outpath = os.path.join(outdir + '/hru_means', os.path.split(self.baseline_file)[-1][:-4])
         self.baseline.write_output(self.baseline.means, '{}hru_means.nhru'.format(baseline_outpath),
                                    timestamp=self.baseline.dt_midpoint)
+        self.outfiles[self.baseline_file] = ['{}hru_means.nhru'.format(baseline_outpath)]
 
         if len(self.periods) > 0:
             for pf, period in self.periods.iteritems():
                 per_outpath = os.path.join(outdir + '/hru_means', os.path.split(pf)[-1][:-4])
                 period.write_output(period.means, '{}hru_means.nhru'.format(per_outpath),
                                     timestamp=period.dt_midpoint)
+                self.outfiles[pf] = ['{}hru_means.nhru'.format(per_outpath)]
 
                 period.pct_diff.replace([np.inf, -np.inf], np.nan, inplace=True)
                 per_outpath = os.path.join(outdir + '/hru_pct_diff', os.path.split(pf)[-1][:-4])
                 period.write_output(period.pct_diff, '{}hru_pct_diff.nhru'.format(per_outpath),
                                     timestamp=period.dt_midpoint)
+                self.outfiles[pf].append('{}hru_pct_diff.nhru'.format(per_outpath))
 
         else:
             per_outpath = os.path.join(outdir + '/hru_means', os.path.split(self.period_files)[-1][:-4])
             self.period.write_output(self.period.means, '{}hru_means.nhru'.format(per_outpath),
                                      timestamp=self.period.dt_midpoint)
+            self.outfiles[self.period_files] = ['{}hru_means.nhru'.format(per_outpath)]
 
             self.period.pct_diff.replace([np.inf, -np.inf], np.nan, inplace=True)
             per_outpath = os.path.join(outdir + '/hru_pct_diff', os.path.split(self.period_files)[-1][:-4])
             self.period.write_output(self.period.pct_diff, '{}hru_pct_diff.nhru'.format(per_outpath),
                                      timestamp=self.period.dt_midpoint)
+            self.outfiles[self.period_files].append('{}hru_pct_diff.nhru'.format(per_outpath))
+
+        if store is not None:
+            periods = self.periods.items() if len(self.periods) > 0 else [(self.period_files, self.period)]
+            store.put('hru_means', *file_labels(self.baseline_file), df=self.baseline.means, save=False)
+            for pf, period in periods:
+                store.put('hru_means', *file_labels(pf), df=period.means, save=False)
+                store.put('hru_pct_diff', *file_labels(pf), df=period.pct_diff, save=False)
+            store.save()
+
+
+class hruComparisons:
+    # percent differences in hru means for a whole set of baseline and period files
+    # (e.g. every gcm and month; see find_comparisons in compare_PRMS_animation.py)
+    # each distinct file is read and reduced to hru means only once, and the percent differences
+    # for all of the periods sharing a baseline are computed as one stacked array operation
+    # (periods x hrus x variables); output files are the same as from hruStatistics
+
+    def __init__(self, nyears=None, chunksize=None, cache=None, error_file='hruComparisons_errors.txt',
+                 prefetch=None, shards=None, max_indices=None, store=None):
+        # prefetch (optional): number of animation files to read (and reduce to means) at once, in background threads
+        # shards (optional): number of processes to split the hrus of each file among, for the means
+        # max_indices (optional): number of hrus to list for each kind of non-finite value in each column
+        # store (optional): ResultStore to also write the means and percent differences to (see write_output)
 
+        self.nyears = nyears
+        self.chunksize = chunksize
+        self.cache = cache
+        self.prefetch = prefetch
+        self.shards = shards
+        self.store = store
+        self.files = {}
+        self.pct_diffs = {}
+        self.nans = False
+        self.nonfinite = NonFiniteReport(max_indices)
+        self.error_file = open(error_file, 'w')
+
+    def means(self, infile):
+        """Return the hru means for an animation file, reading it the first time only.
+        The AnimationFile is kept in self.files (without its data), with the means as ani_file.means.
+        """
+        if infile not in self.files:
+            self.files[infile] = self.read_means(infile)
+        return self.files[infile].means
 
+    def read_means(self, infile):
+        ani_file = AnimationFile(infile, chunksize=self.chunksize, cache=self.cache, nyears=self.nyears)
+        ani_file.means = ani_file.hru_means(shards=self.shards)
+        # only the means are needed from here on
+        ani_file.df = pd.DataFrame()
+        return ani_file
+
+    def compare(self, baseline_file, period_files):
+        """Compute percent differences in hru means between a baseline file and a list of period files.
+
+        Returns
+        -------
+        A dictionary of dataframes of percent differences for each hru (rows),
+        for each state variable (columns), keyed by period file
+        """
+        if self.prefetch is not None:
+            infiles = [f for f in [baseline_file] + period_files if f not in self.files]
+            self.files.update(prefetch_files(self.read_means, infiles, size=self.prefetch))
+        bl_mean = self.means(baseline_file)
+        per_means = [self.means(pf) for pf in period_files]
+
+        # line up all of the means on the same hrus and variables, as pandas would
+        index, columns = bl_mean.index, bl_mean.columns
+        for per_mean in per_means:
+            index = index.union(per_mean.index)
+            columns = columns.union(per_mean.columns)
+        columns = [c for c in self.files[baseline_file].column_names if c in columns]
+        bl = bl_mean.reindex(index=index, columns=columns).values
+        per = np.array([per_mean.reindex(index=index, columns=columns).values for per_mean in per_means])
+
+        with profiler.stage('pct_diff', baseline_file, per.shape[0] * per.shape[1]):
+            with np.errstate(invalid='ignore', divide='ignore'):
+                pct_diff = 100 * (per - bl) / bl
+
+        results = {}
+        nans = False
+        for i, pf in enumerate(period_files):
+            results[pf] = pd.DataFrame(pct_diff[i], index=index, columns=columns)
+            self.pct_diffs[(baseline_file, pf)] = results[pf]
+            with profiler.stage('check_finite', pf, len(index)):
+                nans = check_finite(results[pf], pf, self.error_file, report=self.nonfinite,
+                                    values='percent differences') or nans
+        if nans:
+            print 'Warning, nan values found in percent differences. See error_file.'
+        self.nans = self.nans or nans
+        return results
+
+    def outfile(self, outdir, kind, infile):
+        # output file name, from the kind of output (hru_means or hru_pct_diff) and the input file name
+        return '{}{}.nhru'.format(os.path.join(outdir + '/' + kind, os.path.split(infile)[-1][:-4]), kind)
+
+    def write_output(self, outdir, baseline_file, period_files, nhru_output=True):
+        """Write the hru means and percent differences for a baseline and its period files,
+        to .nhru files in outdir (unless nhru_output is False), and to the store (if there is one),
+        labelled by the scenario, period and month in the file names (see PRMS_animation_store).
+
+        Returns
+        -------
+        A dictionary of the output files written for each input file
+        """
+        outfiles = dict([(infile, []) for infile in [baseline_file] + period_files])
+        if nhru_output:
+            for dir in [outdir, outdir + '/hru_means', outdir + '/hru_pct_diff']:
+                if not os.path.isdir(dir):
+                    os.makedirs(dir)
+
+            for infile in [baseline_file] + period_files:
+                ani_file = self.files[infile]
+                outfiles[infile] = [self.outfile(outdir, 'hru_means', infile)]
+                ani_file.write_output(ani_file.means, outfiles[infile][0], timestamp=ani_file.dt_midpoint)
+
+            for pf in period_files:
+                pct_diff = self.pct_diffs[(baseline_file, pf)].replace([np.inf, -np.inf], np.nan)
+                outfiles[pf].append(self.outfile(outdir, 'hru_pct_diff', pf))
+                self.files[pf].write_output(pct_diff, outfiles[pf][-1], timestamp=self.files[pf].dt_midpoint)
+
+        if self.store is not None:
+            with profiler.stage('write_store', baseline_file):
+                for infile in [baseline_file] + period_files:
+                    self.store.put('hru_means', *file_labels(infile), df=self.files[infile].means, save=False)
+                for pf in period_files:
+                    self.store.put('hru_pct_diff', *file_labels(pf), df=self.pct_diffs[(baseline_file, pf)],
+                                   save=False)
+                self.store.save()
+        return outfiles
+
+    def close(self):
+        self.error_file.close()
 
 
 class PeriodStatistics:
 
-    def __init__(self, operations):
+    def __init__(self, operations, shards=None, store=None):
+        # shards (optional): number of processes to split the hrus of each file among (see sharded_aggregate)
+        # store (optional): ResultStore to also write the annual and monthly statistics to (see write_store)
         self.f = operations
+        self.shards = shards
+        self.store = store
+        self.water_years = False
 
     def Annual(self, ani_file, csv_output=False, ani_output=False):
         # group data by year, using operations specified in config file
@@ -375,16 +1390,71 @@ class PeriodStatistics:
         # format_line=True also renames the Date column to "timestamp," consistent with previous processed files
         
         print "calculating annual statistics..."
-        df = ani_file.df.copy()
+        if GroupAggregator.supports(self.f) or ani_file.chunksize is not None:
+            df_yr_hru = self.aggregate(ani_file, ['year', 'nhru'], water_years=True).result()
+        else:
+            # fall back to pandas for other operations (e.g. median, std)
+            df = self.float64(ani_file.df)
+
+            if df.index[1].month == 10:
+                # data are in water years; shift index to 1982
+                df = df.shift(3, freq='MS')
+
+            with profiler.stage('groupby', ani_file.infile, len(df)):
+                df_yr_hru = df.groupby([lambda x: x.year, 'nhru']).agg(self.f)
 
-        if df.index[1].month == 10:
-            # data are in water years; shift index to 1982
-            df = ani_file.df.shift(3, freq='MS')
-            
-        df_yr_hru = df.groupby([lambda x: x.year, 'nhru']).agg(self.f)
+            # flatten column names
+            df_yr_hru.columns = df_yr_hru.columns.levels[0]
 
-        # flatten column names; preserve original order of variables
-        df_yr_hru.columns = df_yr_hru.columns.levels[0]
+        self.write_annual(ani_file, df_yr_hru, csv_output=csv_output, ani_output=ani_output)
+
+    def Monthly(self, ani_file, csv_output=False, ani_output=False):
+        # group data by month, using operations specified in config file
+        # ani_file: animation file object produced by AnimationFile class
+        # format_line (T/F): whether or not to include the format line (in between the header and the data) in the output
+        # format_line=True also renames the Date column to "timestamp," consistent with previous processed files
+    
+        print "calculating monthly statistics..."
+        if GroupAggregator.supports(self.f) or ani_file.chunksize is not None:
+            df_M_hru = self.aggregate(ani_file, ['month', 'year', 'nhru']).result()
+        else:
+            df = self.float64(ani_file.df)
+            with profiler.stage('groupby', ani_file.infile, len(df)):
+                df_M_hru=df.groupby([lambda x: x.month, lambda x: x.year, 'nhru']).agg(self.f)
+
+            # flatten column names
+            #df_M_hru.columns=[c[0] for c in df_M_hru.columns]
+            #self.df_M=df_M_hru[ani_file.df.columns] # indexing drops the 'nhru' column (already in index)
+            df_M_hru.columns = df_M_hru.columns.levels[0]
+
+        self.write_monthly(ani_file, df_M_hru, csv_output=csv_output, ani_output=ani_output)
+
+    def AnnualMonthly(self, ani_file, csv_output=False, ani_output=False):
+        # annual and monthly statistics from a single pass through the data:
+        # the data are aggregated once by month, year and hru, and the annual statistics
+        # are computed from those partial results (see GroupAggregator.regroup); the output is the same
+        # as running Annual and Monthly, except that annual sums and means can differ in the last digit
+        if not GroupAggregator.supports(self.f) and ani_file.chunksize is None:
+            self.Annual(ani_file, csv_output=csv_output, ani_output=ani_output)
+            self.Monthly(ani_file, csv_output=csv_output, ani_output=ani_output)
+            return
+
+        print "calculating annual and monthly statistics..."
+        monthly = self.aggregate(ani_file, ['month', 'year', 'nhru'])
+        month, year, nhru = monthly.keys
+        if self.water_years:
+            year = year + (month >= 10)
+        annual = monthly.regroup([year, nhru], ['year', 'nhru'])
+
+        self.write_annual(ani_file, annual.result(), csv_output=csv_output, ani_output=ani_output)
+        self.write_monthly(ani_file, monthly.result(), csv_output=csv_output, ani_output=ani_output)
+
+    def write_annual(self, ani_file, df_yr_hru, csv_output=False, ani_output=False):
+
+        if self.store is not None:
+            self.write_store(ani_file, df_yr_hru)
+
+        # preserve original order of variables
         self.df_yr = df_yr_hru[[c for c in ani_file.column_names if c in df_yr_hru.columns]]
         
         # put index back for monthly analysis
@@ -405,29 +1475,20 @@ class PeriodStatistics:
             # write to output
             outfile = '{0}annual.animation.nhru'.format(ani_file.infile.split('\\')[-1].split('animation')[0])
             print "\twriting annual stats to {0}".format(outfile)
-            self.df_yr.to_csv('temp.txt',sep=ani_file.delimiter,float_format='%.6e',index_label='year')
-
-            # if specified, add format line to output file (simply copied from input)
-            self.apply_formatting_to_output(ani_file, 'temp.txt', outfile)
+            self.write_ani_output(ani_file, self.df_yr, outfile)
         else:
             pass
-        
-    def Monthly(self, ani_file, csv_output=False, ani_output=False):
-        # group data by month, using operations specified in config file
-        # ani_file: animation file object produced by AnimationFile class
-        # format_line (T/F): whether or not to include the format line (in between the header and the data) in the output
-        # format_line=True also renames the Date column to "timestamp," consistent with previous processed files
-    
-        print "calculating monthly statistics..."
-        df_M_hru=ani_file.df.groupby([lambda x: x.month, lambda x: x.year, 'nhru']).agg(self.f)
 
-        # flatten column names; preserve original order of variables
-        #df_M_hru.columns=[c[0] for c in df_M_hru.columns]
-        #self.df_M=df_M_hru[ani_file.df.columns] # indexing drops the 'nhru' column (already in index)
-        df_M_hru.columns = df_M_hru.columns.levels[0]
-        self.df_M = df_M_hru[[c for c in ani_file.column_names if c in df_M_hru.columns]]
+    def write_monthly(self, ani_file, df_M_hru, csv_output=False, ani_output=False):
+
+        if self.store is not None:
+            self.write_store(ani_file, df_M_hru, monthly=True)
+
+        # preserve original order of variables
+        df_M_hru = df_M_hru[[c for c in ani_file.column_names if c in df_M_hru.columns]]
 
         # remove hrus from index (they are also in the first column), and reformat to mimic original animation results
+        self.df_M = df_M_hru.copy()
         self.df_M.index = [item[0] for item in self.df_M.index]
 
         # write each month to separate output file
@@ -440,37 +1501,83 @@ class PeriodStatistics:
 
         elif ani_output:
             for i in range(12):
-                # get dataframe for month
-                df_month = self.df_M.ix[1+1] # selects January group for dataframe
+                # get dataframe for month (still indexed by year and hru)
+                df_month = df_M_hru.xs(i+1, level=0)
 
-                df_month.index = ['{0}-09-30:00:00:00'.format(year) for year in df_month.index]
+                df_month.index = ['{0}-09-30:00:00:00'.format(year) for year in df_month.index.get_level_values(0)]
 
                 # write each month to output
                 outfile = '{0}{1}.animation.nhru'.format(ani_file.infile.split('\\')[-1].split('animation')[0],months[i])
                 print "\twriting {0} stats to {1}".format(months[i],outfile)
-                df_month.to_csv('temp.txt',sep=ani_file.delimiter,float_format='%.6e',index_label='year')
-
-                # if specified, add format line to output file (simply copied from input)
-                self.apply_formatting_to_output(ani_file, 'temp.txt', outfile)
+                self.write_ani_output(ani_file, df_month, outfile)
         else:
             pass
                 
-    def apply_formatting_to_output(self, ani_file, outfile, formatted_outfile):
-        # reopen output file, just to add in formatting line! (should only run this method if necessary)
-        
-        with open(outfile,'r') as input_file:
-            with open(formatted_outfile,'w') as output:
+    def aggregate(self, ani_file, by, water_years=False):
+        # group data using operations specified in config file, with integer group labels and numpy reductions
+        # (all variables in one pass); files opened with a chunksize are read in blocks of rows
+        # by: list of group labels, from 'month', 'year' and 'nhru'
+        # water_years (T/F): if the data are in water years (start in October),
+        # count October-December toward the following year
+        # returns a GroupAggregator
+        if self.shards is not None:
+            aggregator, self.water_years = sharded_aggregate(ani_file, self.f, by, self.shards,
+                                                             water_years=water_years)
+            return aggregator
+
+        aggregator = GroupAggregator(self.f)
+        if ani_file.chunksize is not None:
+            chunks = ani_file.iter_chunks()
+        else:
+            chunks = [ani_file.df]
+        for chunk in chunks:
+            with profiler.stage('groupby', ani_file.infile, len(chunk)):
+                if aggregator.first is None:
+                    self.water_years = chunk.index[1].month == 10
+                years, months = calendar_codes(chunk.index)
+                months_elapsed = years * 12 + months
+                if water_years and self.water_years:
+                    years = years + (months >= 10)
+                keys = {'month': months, 'year': years, 'nhru': chunk['nhru'].values}
+                # the records are in time order, so groups for earlier months (or years) are complete
+                periods = None
+                if 'year' in by:
+                    periods = months_elapsed if 'month' in by else years
+                aggregator.update(chunk, [keys[k] for k in by], by, periods=periods)
+        aggregator.finish()
+        return aggregator
+
+    def write_store(self, ani_file, df, monthly=False):
+        # add statistics indexed by (year, hru), or (month, year, hru) if monthly, to the store,
+        # as a chunk of hrus and variables for each year (period label) and month (or 'annual');
+        # the scenario label is the name of the input file
+        months = ['jan','feb','mar','apr','may','jun','jul','aug','sep','oct','nov','dec']
+        scenario = os.path.split(ani_file.infile)[1].split('.animation')[0]
+        columns = [c for c in ani_file.column_names if c in df.columns and c != 'nhru']
+        with profiler.stage('write_store', ani_file.infile, len(df)):
+            for labels, group in df[columns].groupby(level=[0, 1] if monthly else 0):
+                month, year = (months[labels[0] - 1], labels[1]) if monthly else ('annual', labels)
+                group.index = group.index.get_level_values(-1)
+                self.store.put('period_statistics', scenario, year, month, group, save=False)
+            self.store.save()
+
+    def float64(self, df):
+        # columns loaded as 32-bit floats are converted before grouping with pandas,
+        # so that the statistics are accumulated in 64 bits
+        float32 = [c for c in df.columns if df[c].dtype == np.float32]
+        if len(float32) == 0:
+            return df
+        return df.astype(dict([(c, np.float64) for c in float32]))
+
+    def write_ani_output(self, ani_file, df, outfile):
+        # write statistics in the layout of the original animation file:
+        # column names and format line (simply copied from input), followed by the data,
+        # streamed straight to the output file
+        with profiler.stage('write_output', ani_file.infile, len(df)):
+            with open(outfile, 'w') as output:
                 output.write(ani_file.delimiter.join(ani_file.column_names)+'\n')
-                input_file.next()
-                output.write(ani_file.format_line)
-                input=True
-                while input:
-                    try:
-                        output.write(input_file.next())
-                    except:
-                        input=False
-                        #break
-            output.close()
+                output.write(ani_file.formats_line)
+                df.to_csv(output, sep=ani_file.delimiter, float_format='%.6e', header=False)
         
         
 class InputFileError(Exception):
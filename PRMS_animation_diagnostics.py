@@ -0,0 +1,142 @@
+"""
+Diagnostics for non-finite values (nans and +/- inf) in hru results
+
+Percent differences from a baseline with zero means (e.g. snow variables in warm hrus) are nan or inf
+for many hrus. Non-finite cells are found in a single pass over the array of values, and classified by kind;
+the hrus for each column and kind are listed as compressed ranges (e.g. 1-250, 300), up to an optional cap.
+Findings for each file are written to the error file as a short table, and can also be collected
+in a NonFiniteReport, and written to a structured csv or json report at the end of a run.
+"""
+import numpy as np
+import pandas as pd
+from PRMS_animation_profile import write_report
+
+KINDS = ['nan', '+inf', '-inf']
+
+
+def compress_ranges(indices, max_indices=None):
+    """Write a sequence of indices (e.g. hru numbers) as a compact string of ranges (e.g. '1-5, 8, 10-12').
+
+    Parameters
+    ----------
+    indices : sequence
+        Indices to list; integer indices are sorted and consecutive runs collapsed into ranges
+    max_indices : int (optional)
+        Only list this many indices, followed by a count of the rest
+    """
+    indices = np.asarray(indices)
+    n = len(indices)
+    if max_indices is not None:
+        indices = indices[:max_indices]
+    if indices.dtype.kind in 'iu' and len(indices) > 0:
+        indices = np.unique(indices)
+        # starts of runs of consecutive values
+        breaks = np.flatnonzero(np.diff(indices) != 1) + 1
+        starts = indices[np.r_[0, breaks]]
+        ends = indices[np.r_[breaks - 1, len(indices) - 1]]
+        # (there can be hundreds of thousands of scattered hrus, so only the ranges are formatted one at a time)
+        text = map(str, starts.tolist())
+        for i in np.flatnonzero(starts != ends):
+            text[i] = '{}-{}'.format(text[i], ends[i])
+        text = ', '.join(text)
+    else:
+        text = ', '.join(['{}'.format(i) for i in indices])
+    if n > len(indices):
+        text += ' (and {} more)'.format(n - len(indices))
+    return text
+
+
+def find_nonfinite(dataframe, exclude_cols=[]):
+    """Find the non-finite values in a dataframe, in one pass over all of its columns.
+
+    Returns
+    -------
+    A dataframe of counts of each kind of non-finite value (nan, +inf, -inf; columns)
+    for each column with any (rows), and a dictionary of the index values (e.g. hrus)
+    with each kind of non-finite value, keyed by (column, kind)
+    """
+    if isinstance(exclude_cols, basestring):
+        exclude_cols = [exclude_cols]
+    columns = [c for c in dataframe.columns if c not in exclude_cols]
+    values = dataframe[columns].values
+    if values.dtype.kind != 'f':
+        values = values.astype(np.float64)
+
+    # (cells in column order, then row order)
+    cols, rows = np.nonzero(~np.isfinite(values.T))
+    if len(rows) == 0:
+        return pd.DataFrame(columns=KINDS), {}
+
+    # kind of each non-finite value: 0 nan, 1 +inf, 2 -inf
+    v = values[rows, cols]
+    kinds = np.where(np.isnan(v), 0, np.where(np.isposinf(v), 1, 2))
+    counts = np.zeros((len(columns), len(KINDS)), dtype=int)
+    np.add.at(counts, (cols, kinds), 1)
+
+    # group the rows by column and kind (a stable sort, so the indices stay in order)
+    order = np.argsort(cols * len(KINDS) + kinds, kind='mergesort')
+    keys = cols[order] * len(KINDS) + kinds[order]
+    bounds = np.r_[0, np.flatnonzero(np.diff(keys)) + 1, len(keys)]
+    index = dataframe.index.values
+    indices = {}
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        c, k = divmod(keys[lo], len(KINDS))
+        indices[(columns[c], KINDS[k])] = index[rows[order[lo:hi]]]
+
+    has_nonfinite = counts.sum(axis=1) > 0
+    counts = pd.DataFrame(counts[has_nonfinite], index=[col for col, has in zip(columns, has_nonfinite) if has],
+                          columns=KINDS)
+    return counts, indices
+
+
+class NonFiniteReport:
+    # non-finite values found in each file, by column and kind,
+    # with the hrus listed as compressed ranges (see compress_ranges)
+
+    fields = ['file', 'column', 'kind', 'count', 'indices']
+
+    def __init__(self, max_indices=None):
+        self.max_indices = max_indices
+        self.records = []
+
+    def check(self, dataframe, file, errorfile=None, exclude_cols=[], values=None):
+        """Check a dataframe for non-finite values, adding any to the report,
+        and writing a summary to errorfile (if supplied), headed by the file name
+        and a description of the values (e.g. 'percent differences'), if supplied.
+
+        Returns
+        -------
+        True if any non-finite values were found
+        """
+        counts, indices = find_nonfinite(dataframe, exclude_cols=exclude_cols)
+        if len(counts) == 0:
+            return False
+        records = [{'file': file, 'column': column, 'kind': kind, 'count': len(indices[(column, kind)]),
+                    'indices': compress_ranges(indices[(column, kind)], self.max_indices)}
+                   for column in counts.index for kind in KINDS if (column, kind) in indices]
+        self.records += records
+
+        if errorfile is not None:
+            errorfile.write('{}:\n'.format(file if values is None else '{}\n(in {})'.format(file, values)))
+            errorfile.write('Number of non-finite values by column:\n')
+            errorfile.write(counts.to_string())
+            errorfile.write('\n{} with non-finite values:\n'.format(dataframe.index.name or 'Indices'))
+            for r in records:
+                errorfile.write('{} ({}): {}\n'.format(r['column'], r['kind'], r['indices']))
+            errorfile.write('\n')
+        return True
+
+    def totals(self):
+        """Return the counts of each kind of non-finite value for each column, summed over files.
+        """
+        totals = {}
+        for r in self.records:
+            totals[(r['column'], r['kind'])] = totals.get((r['column'], r['kind']), 0) + r['count']
+        return [{'column': c, 'kind': k, 'count': n} for (c, k), n in sorted(totals.items())]
+
+    def write(self, outfile):
+        """Write the records to a csv file, or a json file (with totals for each column and kind),
+        depending on the extension of outfile.
+        """
+        write_report(outfile, self.fields, self.records, self.totals())
+        print 'wrote non-finite value report to {}'.format(outfile)
@@ -0,0 +1,243 @@
+"""
+Summaries of hru means and percent differences across a whole ensemble of gcms, scenarios, periods and months
+
+Output files from hruStatistics (or hruComparisons) are read one at a time, and reduced to running statistics
+for each variable (count, mean, variance, min and max), along with a histogram of logarithmically spaced bins
+for approximate quantiles. The statistics from different files (or runs) are merged exactly, except for the
+quantiles, which are accurate to within the bin width (about 0.5% of the value, with 64 bins per doubling).
+
+Per-hru medians and spreads across gcms are computed one group of files (same scenario, period and month) at a time.
+So the whole ensemble is never held in memory at once.
+"""
+import os
+import json
+import warnings
+import numpy as np
+import pandas as pd
+
+
+def read_output_file(filename):
+    """Read an hru_means or hru_pct_diff file written by AnimationFile.write_output.
+
+    Returns
+    -------
+    A dataframe of values for each hru (rows), for each variable (columns)
+    """
+    with open(filename) as input_file:
+        for header_row, line in enumerate(input_file):
+            if line.startswith('timestamp'):
+                column_names = line.strip().split('\t')
+                break
+    df = pd.read_csv(filename, delim_whitespace=True, header=None, names=column_names,
+                     skiprows=header_row + 2, na_values=['NAN'])
+    df['nhru'] = df['nhru'].astype(int)
+    return df.drop('timestamp', axis=1).set_index('nhru')
+
+
+class RunningStats:
+    # mergeable statistics for the values of one variable:
+    # count, mean and sum of squared deviations (combined with Chan's parallel algorithm), min, max,
+    # and counts of values in logarithmically spaced bins (separately for positive and negative values, and zeros)
+
+    def __init__(self, bins_per_doubling=64):
+        self.bins_per_doubling = bins_per_doubling
+        self.count = 0
+        self.mean = 0.
+        self.m2 = 0.
+        self.min = np.nan
+        self.max = np.nan
+        self.zeros = 0
+        self.positive = {}
+        self.negative = {}
+
+    def update(self, values):
+        """Add an array of values (nans and infs are skipped).
+        """
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[np.isfinite(values)]
+        if len(values) == 0:
+            return
+        other = RunningStats(self.bins_per_doubling)
+        other.count = len(values)
+        other.mean = values.mean()
+        other.m2 = np.sum((values - other.mean) ** 2)
+        other.min = values.min()
+        other.max = values.max()
+        other.zeros = int(np.sum(values == 0))
+        for bins, v in [(other.positive, values[values > 0]), (other.negative, -values[values < 0])]:
+            keys, counts = np.unique(self.bin(v), return_counts=True)
+            bins.update(zip(keys.tolist(), counts.tolist()))
+        self.merge(other)
+
+    def bin(self, values):
+        # bin number of each (positive) value
+        return np.floor(np.log2(values) * self.bins_per_doubling).astype(np.int64)
+
+    def bin_value(self, key):
+        # representative value for a bin (its geometric midpoint)
+        return 2 ** ((key + 0.5) / self.bins_per_doubling)
+
+    def merge(self, other):
+        """Combine the statistics from another RunningStats into this one.
+        """
+        if other.bins_per_doubling != self.bins_per_doubling:
+            raise ValueError('Statistics with different bins can\'t be merged.')
+        if other.count == 0:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta ** 2 * self.count * other.count / count
+        self.count = count
+        self.min = np.fmin(self.min, other.min)
+        self.max = np.fmax(self.max, other.max)
+        self.zeros += other.zeros
+        for bins, other_bins in [(self.positive, other.positive), (self.negative, other.negative)]:
+            for key, n in other_bins.iteritems():
+                bins[key] = bins.get(key, 0) + n
+
+    @property
+    def std(self):
+        # sample standard deviation, as in pandas
+        if self.count < 2:
+            return np.nan
+        return np.sqrt(self.m2 / (self.count - 1))
+
+    def quantile(self, q):
+        """Approximate quantile (0 <= q <= 1) from the histogram.
+        """
+        if self.count == 0:
+            return np.nan
+        # bins in order of value: negative values (largest magnitude first), zeros, then positive values
+        negative = sorted(self.negative.keys(), reverse=True)
+        positive = sorted(self.positive.keys())
+        values = [-self.bin_value(k) for k in negative] + [0.] + [self.bin_value(k) for k in positive]
+        counts = [self.negative[k] for k in negative] + [self.zeros] + [self.positive[k] for k in positive]
+        # interpolate between the values at the ranks on either side, as in pandas
+        rank = q * (self.count - 1)
+        i = np.searchsorted(np.cumsum(counts), [np.floor(rank), np.ceil(rank)], side='right')
+        lower, upper = np.clip([values[min(j, len(values) - 1)] for j in i], self.min, self.max)
+        return float(lower + (upper - lower) * (rank - np.floor(rank)))
+
+    def to_dict(self):
+        return {'bins_per_doubling': self.bins_per_doubling, 'count': self.count, 'mean': self.mean,
+                'm2': self.m2, 'min': self.min, 'max': self.max, 'zeros': self.zeros,
+                'positive': self.positive, 'negative': self.negative}
+
+    @classmethod
+    def from_dict(cls, d):
+        stats = cls(d['bins_per_doubling'])
+        for attr in ['count', 'mean', 'm2', 'min', 'max', 'zeros']:
+            setattr(stats, attr, d[attr])
+        # (json keys are strings)
+        stats.positive = dict([(int(k), n) for k, n in d['positive'].items()])
+        stats.negative = dict([(int(k), n) for k, n in d['negative'].items()])
+        return stats
+
+
+class EnsembleSummary:
+    # summary statistics for each variable across a set of hru_means or hru_pct_diff files,
+    # laid out like dataframe.describe(), without concatenating the files
+
+    def __init__(self, percentiles=[0.1, 0.5, 0.9], bins_per_doubling=64):
+        # the median is always included, as in describe()
+        self.percentiles = sorted(set(percentiles) | set([0.5]))
+        self.bins_per_doubling = bins_per_doubling
+        self.stats = {}
+        self.columns = []
+        self.files = []
+
+    def add(self, df):
+        """Add the values in a dataframe (e.g. from read_output_file) to the running statistics.
+        """
+        for c in df.columns:
+            if c not in self.stats:
+                self.stats[c] = RunningStats(self.bins_per_doubling)
+                self.columns.append(c)
+            self.stats[c].update(df[c].values)
+
+    def add_file(self, filename):
+        self.add(read_output_file(filename))
+        self.files.append(filename)
+
+    def merge(self, other):
+        """Combine the statistics from another EnsembleSummary (e.g. from a separate run) into this one.
+        """
+        for c in other.columns:
+            if c not in self.stats:
+                self.stats[c] = RunningStats(self.bins_per_doubling)
+                self.columns.append(c)
+            self.stats[c].merge(other.stats[c])
+        self.files += other.files
+
+    def describe(self):
+        """Return a dataframe of summary statistics (rows) for each variable (columns),
+        as from dataframe.describe(percentiles) on all of the files concatenated.
+        """
+        index = ['count', 'mean', 'std', 'min'] + ['{:g}%'.format(100 * p) for p in self.percentiles] + ['max']
+        results = {}
+        for c in self.columns:
+            s = self.stats[c]
+            results[c] = [s.count, s.mean if s.count > 0 else np.nan, s.std, s.min] + \
+                         [s.quantile(p) for p in self.percentiles] + [s.max]
+        return pd.DataFrame(results, index=index, columns=self.columns)
+
+    def save(self, outfile):
+        # save the running statistics as json, to be merged with later runs (see EnsembleSummary.load)
+        with open(outfile, 'w') as output:
+            json.dump({'percentiles': self.percentiles, 'columns': self.columns, 'files': self.files,
+                       'stats': dict([(c, self.stats[c].to_dict()) for c in self.columns])}, output)
+
+    @classmethod
+    def load(cls, infile):
+        with open(infile) as input_file:
+            d = json.load(input_file)
+        summary = cls(d['percentiles'])
+        summary.columns = [str(c) for c in d['columns']]
+        summary.files = d['files']
+        summary.stats = dict([(str(c), RunningStats.from_dict(s)) for c, s in d['stats'].items()])
+        if len(summary.stats) > 0:
+            summary.bins_per_doubling = summary.stats.values()[0].bins_per_doubling
+        return summary
+
+
+def ensemble_groups(files):
+    """Group output files that differ only by gcm
+    (files named <gcm>.<scenario>.<period>.<month>.animation.<kind>.nhru).
+
+    Returns
+    -------
+    A dictionary of lists of files, keyed by the rest of the file name (without the gcm)
+    """
+    groups = {}
+    for f in sorted(files):
+        name = os.path.split(f)[1]
+        groups.setdefault('.'.join(name.split('.')[1:]), []).append(f)
+    return groups
+
+
+def hru_ensemble(files):
+    """Median and spread (max - min) of the values for each hru, across a group of output files
+    (e.g. the same scenario, period and month from each gcm; see ensemble_groups).
+
+    Returns
+    -------
+    A dataframe indexed by hru, with columns <variable>_median and <variable>_spread for each variable
+    """
+    frames = [read_output_file(f) for f in files]
+    index, columns = frames[0].index, list(frames[0].columns)
+    for df in frames[1:]:
+        index = index.union(df.index)
+        columns += [c for c in df.columns if c not in columns]
+    values = np.array([df.reindex(index=index, columns=columns).values for df in frames])
+
+    results = {}
+    with warnings.catch_warnings():
+        # hrus with no finite values in any of the files (e.g. percent differences from a zero baseline)
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for i, c in enumerate(columns):
+            v = values[:, :, i]
+            results['{}_median'.format(c)] = np.nanmedian(v, axis=0)
+            results['{}_spread'.format(c)] = np.nanmax(v, axis=0) - np.nanmin(v, axis=0)
+    names = [n for c in columns for n in ['{}_median'.format(c), '{}_spread'.format(c)]]
+    return pd.DataFrame(results, index=index, columns=names)
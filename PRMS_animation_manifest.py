@@ -0,0 +1,113 @@
+"""
+Manifest of completed outputs, for incremental and restartable batch runs
+
+The manifest is a json file in the output folder, with an entry for each job (e.g. a baseline-period comparison).
+Each entry records the modification time and size of the job's input and output files, and a hash of the settings
+it was run with. A job only needs to be run again if any of these have changed, or if an output is missing.
+"""
+import os
+import json
+import hashlib
+
+
+def file_signature(filename):
+    # modification time and size; cheap to check, even for multi-GB animation files
+    stat = os.stat(filename)
+    return [stat.st_mtime, stat.st_size]
+
+
+def config_hash(config):
+    # hash of the settings a job was run with (e.g. operations, nyears)
+    return hashlib.md5(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def replace_file(source, destination):
+    """Replace destination with source (e.g. a temporary file that has just been written),
+    so that a killed run leaves either the old file or the new one.
+    On POSIX systems, source is renamed over destination in one step. On Windows, where a file can't be
+    renamed over another, the old file is set aside as <destination>.bak until the new one is in place
+    (see load_json).
+    """
+    if os.name != 'nt':
+        os.rename(source, destination)
+        return
+    backup = '{}.bak'.format(destination)
+    if os.path.isfile(destination):
+        if os.path.isfile(backup):
+            os.remove(backup)
+        os.rename(destination, backup)
+    os.rename(source, destination)
+    if os.path.isfile(backup):
+        os.remove(backup)
+
+
+def load_json(filename):
+    """Load a json file that is saved by writing <filename>.tmp, then replacing filename with it (see replace_file).
+    If the run was killed while filename was being replaced, it's recovered from <filename>.tmp (if that
+    was written completely), or <filename>.bak (the old version).
+
+    Returns
+    -------
+    The contents of the file, or None if there is no readable version
+    """
+    for f in [filename, '{}.tmp'.format(filename), '{}.bak'.format(filename)]:
+        if os.path.isfile(f):
+            try:
+                with open(f) as input_file:
+                    return json.load(input_file)
+            except ValueError:
+                # partly written
+                continue
+    return None
+
+
+class Manifest:
+
+    def __init__(self, outdir, filename='manifest.json'):
+
+        self.manifest_file = os.path.join(outdir, filename)
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+        # (if there's no readable manifest, start over)
+        self.jobs = load_json(self.manifest_file) or {}
+
+    def is_current(self, job, inputs, config=None):
+        """Return True if a job was completed with the same input files and settings,
+        and its output files haven't changed since.
+
+        Parameters
+        ----------
+        job : str
+            Name identifying the job
+        inputs : list of str
+            Input files for the job
+        config : dict (optional)
+            Settings for the job (must be json-serializable)
+        """
+        entry = self.jobs.get(job)
+        if entry is None:
+            return False
+        if entry['config'] != config_hash(config):
+            return False
+        if sorted(entry['inputs'].keys()) != sorted(inputs):
+            return False
+        for files in [entry['inputs'], entry['outputs']]:
+            for f, signature in files.items():
+                if not os.path.isfile(f) or file_signature(f) != signature:
+                    return False
+        return True
+
+    def record(self, job, inputs, outputs, config=None):
+        """Record a completed job, and save the manifest.
+        """
+        self.jobs[job] = {'inputs': dict([(f, file_signature(f)) for f in inputs]),
+                          'outputs': dict([(f, file_signature(f)) for f in outputs]),
+                          'config': config_hash(config)}
+        self.save()
+
+    def save(self):
+        # write to a temporary file first, so that a killed run never leaves a partial manifest
+        tempfile = '{}.tmp'.format(self.manifest_file)
+        with open(tempfile, 'w') as output:
+            json.dump(self.jobs, output, indent=1, sort_keys=True)
+        replace_file(tempfile, self.manifest_file)
@@ -0,0 +1,194 @@
+"""
+Timing and memory instrumentation for PRMS animation processing
+
+The hot paths in PRMS_animation_classes (header sniffing, read_csv, timestamp parsing, grouping,
+percent differences, checks for non-finite values, and output formatting) are wrapped in profiler.stage().
+Instrumentation is off by default; when it's off, stage() returns a shared do-nothing context,
+so the cost is a single attribute check. When it's on, wall time, rows processed and resident memory
+are accumulated for each stage and file, and written to a json or csv report with profiler.report().
+
+Memory is recorded as the resident memory at the end of each stage (rss_mb), and the largest change in
+resident memory over one pass through the stage (rss_change_mb), both from psutil if it's installed, or else
+/proc/self/statm (Linux). The high-water mark of the whole process (process_peak_rss_mb) is also recorded;
+it's cumulative, so after the largest allocation in a run it's the same for every later stage and file.
+"""
+import os
+import sys
+import csv
+import json
+import time
+import threading
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows; the process peak isn't recorded
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    # optional; without it, resident memory is only recorded on Linux (see rss_mb)
+    psutil = None
+
+
+def peak_rss_mb():
+    # peak resident memory of this process so far, in MB
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return maxrss / 2.**20
+    return maxrss / 2.**10
+
+
+def rss_mb():
+    # current resident memory of this process, in MB (None if it can't be measured)
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / 2.**20
+    if resource is None or not os.path.isfile('/proc/self/statm'):
+        return None
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize() / 2.**20
+
+
+def write_report(outfile, fields, records, totals):
+    """Write records to a csv file (with the given fields as columns), or to a json file
+    (with the records under 'files' and the totals under 'totals'), depending on the extension of outfile.
+    """
+    if os.path.splitext(outfile)[1].lower() == '.csv':
+        with open(outfile, 'wb') as output:
+            writer = csv.DictWriter(output, fields)
+            writer.writeheader()
+            writer.writerows(records)
+    else:
+        with open(outfile, 'w') as output:
+            json.dump({'files': records, 'totals': totals}, output, indent=1)
+
+
+class Stage:
+    # times one pass through a stage, and adds it to the profiler's records on exit;
+    # set stage.rows inside the with block if the number of rows isn't known beforehand
+
+    def __init__(self, profiler, name, infile=None, rows=None):
+        self.profiler = profiler
+        self.name = name
+        self.infile = infile
+        self.rows = rows
+
+    def __enter__(self):
+        self.rss0 = rss_mb()
+        self.t0 = time.time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        seconds = time.time() - self.t0
+        self.profiler.add(self.name, self.infile, seconds, self.rows, rss=(self.rss0, rss_mb()))
+        return False
+
+
+class NullStage:
+    # stand-in for Stage when profiling is off
+    rows = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return False
+
+
+class Profiler:
+    # records are accumulated by (stage, file), so that stages run once per block of rows
+    # (e.g. when reading in chunks) add up to one entry per file
+    # stages may be timed from several threads (e.g. files read ahead by prefetch), so records are updated with a lock
+
+    fields = ['file', 'stage', 'calls', 'seconds', 'rows', 'rows_per_second', 'rss_mb', 'rss_change_mb',
+              'process_peak_rss_mb']
+
+    def __init__(self):
+        self.enabled = False
+        self.records = {}
+        self.null_stage = NullStage()
+        self.lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def clear(self):
+        self.records = {}
+
+    def stage(self, name, infile=None, rows=None):
+        """Return a context manager that times a stage of processing for a file.
+
+        Parameters
+        ----------
+        name : str
+            Name of the stage (e.g. 'read_csv')
+        infile : str (optional)
+            File being processed
+        rows : int (optional)
+            Number of rows processed (can also be set on the returned object)
+        """
+        if not self.enabled:
+            return self.null_stage
+        return Stage(self, name, infile, rows)
+
+    def add(self, name, infile, seconds, rows=None, rss=None):
+        # rss (optional): resident memory (MB) at the start and end of the stage (see rss_mb)
+        with self.lock:
+            record = self.records.setdefault((name, infile), {'file': infile, 'stage': name, 'calls': 0,
+                                                              'seconds': 0., 'rows': 0, 'rss_mb': None,
+                                                              'rss_change_mb': None, 'process_peak_rss_mb': None})
+            record['calls'] += 1
+            record['seconds'] += seconds
+            if rows is not None:
+                record['rows'] += rows
+            if rss is not None and None not in rss:
+                record['rss_mb'] = max(record['rss_mb'], rss[1])
+                record['rss_change_mb'] = max(record['rss_change_mb'], rss[1] - rss[0])
+            record['process_peak_rss_mb'] = peak_rss_mb()
+
+    def merge(self, records):
+        """Add records from another profiler (e.g. from a worker process; see Profiler.results).
+        """
+        for r in records:
+            record = self.records.setdefault((r['stage'], r['file']), dict(r, calls=0, seconds=0., rows=0))
+            record['calls'] += r['calls']
+            record['seconds'] += r['seconds']
+            record['rows'] += r['rows']
+            for field in ['rss_mb', 'rss_change_mb', 'process_peak_rss_mb']:
+                record[field] = max(record[field], r[field])
+
+    def results(self):
+        """Return a list of the records for each stage and file, with throughput in rows per second.
+        """
+        results = []
+        for key in sorted(self.records.keys(), key=lambda k: (str(k[1]), k[0])):
+            record = dict(self.records[key])
+            record['rows_per_second'] = None
+            if record['rows'] > 0 and record['seconds'] > 0:
+                record['rows_per_second'] = record['rows'] / record['seconds']
+            results.append(record)
+        return results
+
+    def totals(self):
+        """Return the records summed over files, for each stage.
+        """
+        totals = Profiler()
+        totals.merge([dict(r, file=None) for r in self.results()])
+        return totals.results()
+
+    def report(self, outfile):
+        """Write the records to a csv file, or a json file (with totals for each stage),
+        depending on the extension of outfile.
+        """
+        write_report(outfile, self.fields, self.results(), self.totals())
+        print 'wrote profile to {}'.format(outfile)
+
+
+# profiler used by PRMS_animation_classes
+profiler = Profiler()
@@ -0,0 +1,183 @@
+"""
+Consolidated store of hru results, as labelled arrays (scenario x period x month x hru x variable)
+
+Instead of a small formatted text file for each scenario, period and month, results are appended to a single
+data file as compressed chunks, one for each (scenario, period, month), holding the values for every hru
+and variable. A small json index next to the data file (<path>.json) records the labels along each dimension,
+and where each chunk is. Chunks are appended as results are computed, so a batch can be stopped and resumed;
+reading the results for one scenario, period and month only decompresses one chunk.
+
+Separate arrays (e.g. hru_means and hru_pct_diff) are kept in the same store, each with its own hrus and variables.
+Writing a chunk that is already in the store replaces it in the index (the old data are left in the file).
+Only one process should write to a store at a time.
+"""
+import os
+import json
+import zlib
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from PRMS_animation_manifest import replace_file, load_json
+
+DIMS = ['scenario', 'period', 'month', 'nhru', 'variable']
+
+
+def file_labels(infile):
+    """Scenario, period and month labels for an animation file, or output file, named
+    <gcm>.<scenario>.<period>.<month>.animation... (the scenario label is <gcm>.<scenario>).
+    """
+    name = os.path.split(infile)[1].split('.animation')[0]
+    parts = name.split('.')
+    if len(parts) < 4:
+        raise ValueError('{} isn\'t named <gcm>.<scenario>.<period>.<month>.animation...'.format(infile))
+    return '.'.join(parts[:-2]), parts[-2], parts[-1]
+
+
+class ResultStore:
+
+    def __init__(self, path, dtype=np.float64, compression=1):
+        # path: data file for the store (created if it doesn't exist); the index is <path>.json
+        # dtype: type the values are stored as
+        # compression: zlib compression level (1 is fastest)
+
+        self.path = path
+        self.index_file = '{}.json'.format(path)
+        self.dtype = np.dtype(dtype)
+        self.compression = compression
+        self.labels = dict([(dim, []) for dim in DIMS[:3]])
+        self.arrays = {}
+        folder = os.path.split(os.path.abspath(path))[0]
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        # (the index is recovered if a run was killed while saving it; see load_json)
+        index = load_json(self.index_file)
+        if index is not None:
+            self.dtype = np.dtype(str(index['dtype']))
+            self.labels = dict([(str(dim), [str(l) for l in labels]) for dim, labels in index['labels'].items()])
+            for name, array in index['arrays'].items():
+                self.arrays[str(name)] = {'nhru': array['nhru'], 'variable': [str(v) for v in array['variable']],
+                                          'chunks': dict([((str(s), str(p), str(m)), (offset, nbytes))
+                                                          for s, p, m, offset, nbytes in array['chunks']])}
+
+    def save(self):
+        # write to a temporary file first, then replace the index with it,
+        # so that a killed run never leaves a partial (or missing) index (see replace_file)
+        # (data appended after the last save are ignored)
+        index = {'dims': DIMS, 'dtype': self.dtype.str, 'labels': self.labels,
+                 'arrays': dict([(name, {'nhru': array['nhru'], 'variable': array['variable'],
+                                         'chunks': [list(key) + list(location)
+                                                    for key, location in sorted(array['chunks'].items())]})
+                                 for name, array in self.arrays.items()])}
+        tempfile = '{}.tmp'.format(self.index_file)
+        with open(tempfile, 'w') as output:
+            json.dump(index, output)
+        replace_file(tempfile, self.index_file)
+
+    def append(self, values):
+        # compress an array onto the end of the data file; returns its location (offset, number of bytes)
+        data = zlib.compress(np.ascontiguousarray(values).tostring(), self.compression)
+        with open(self.path, 'ab') as output:
+            output.seek(0, os.SEEK_END)
+            offset = output.tell()
+            output.write(data)
+        return offset, len(data)
+
+    def read_chunk(self, location, dtype, shape):
+        offset, nbytes = location
+        with open(self.path, 'rb') as input_file:
+            input_file.seek(offset)
+            data = input_file.read(nbytes)
+        return np.frombuffer(zlib.decompress(data), dtype=dtype).reshape(shape)
+
+    def put(self, name, scenario, period, month, df, save=True):
+        """Add the values for each hru (rows) and variable (columns) in a dataframe to an array in the store,
+        at the given scenario, period and month labels.
+
+        The first dataframe added to an array sets its hrus and variables; later dataframes
+        are lined up with them (missing values are stored as nan).
+
+        Parameters
+        ----------
+        name : str
+            Name of the array (e.g. 'hru_means')
+        scenario, period, month : str
+            Labels for the chunk (see file_labels)
+        df : dataframe
+            Values indexed by hru, with a column for each variable
+        save : T/F
+            Save the index after adding the chunk (if False, call save() after adding a group of chunks)
+        """
+        if name not in self.arrays:
+            self.arrays[name] = {'nhru': [int(i) for i in df.index], 'variable': [str(c) for c in df.columns],
+                                 'chunks': {}}
+        array = self.arrays[name]
+        extra = df.index.difference(array['nhru']).tolist() + df.columns.difference(array['variable']).tolist()
+        if len(extra) > 0:
+            raise ValueError('{} in {} has hrus or variables that aren\'t in the store: {}'.format(
+                name, (scenario, period, month), extra[:10]))
+        values = df.reindex(index=array['nhru'], columns=array['variable']).values.astype(self.dtype)
+
+        key = (str(scenario), str(period), str(month))
+        array['chunks'][key] = self.append(values)
+        for dim, label in zip(DIMS[:3], key):
+            if label not in self.labels[dim]:
+                self.labels[dim].append(label)
+        if save:
+            self.save()
+
+    def has(self, name, scenario, period, month):
+        return name in self.arrays and (str(scenario), str(period), str(month)) in self.arrays[name]['chunks']
+
+    def get(self, name, scenario, period, month):
+        """Read the values for one scenario, period and month.
+
+        Returns
+        -------
+        A dataframe of values for each hru (rows), for each variable (columns)
+        """
+        array = self.arrays[name]
+        values = self.read_chunk(array['chunks'][(str(scenario), str(period), str(month))], self.dtype,
+                                 (len(array['nhru']), len(array['variable'])))
+        return pd.DataFrame(values, index=pd.Index(array['nhru'], name='nhru'), columns=array['variable'])
+
+    def select(self, name, scenario=None, period=None, month=None, nhru=None, variable=None):
+        """Read a slice of an array, as a 5-dimensional array of values (scenario, period, month, nhru, variable).
+        Only the chunks in the slice are read; scenarios, periods and months without results are nan.
+
+        Parameters
+        ----------
+        name : str
+            Name of the array (e.g. 'hru_pct_diff')
+        scenario, period, month, nhru, variable : label or list of labels (optional)
+            Labels to select along each dimension (default all)
+
+        Returns
+        -------
+        values : ndarray
+            Values in the slice
+        coords : OrderedDict
+            Labels along each dimension of values
+        """
+        array = self.arrays[name]
+        coords = OrderedDict()
+        for dim, selection in zip(DIMS, [scenario, period, month, nhru, variable]):
+            labels = self.labels[dim] if dim in self.labels else array[dim]
+            if selection is None:
+                selection = labels
+            elif np.isscalar(selection):
+                selection = [selection]
+            coords[dim] = list(selection)
+        rows = pd.Index(array['nhru']).get_indexer(coords['nhru'])
+        columns = pd.Index(array['variable']).get_indexer(coords['variable'])
+        if (rows < 0).any() or (columns < 0).any():
+            raise KeyError('hrus or variables not in {}'.format(name))
+
+        values = np.full([len(c) for c in coords.values()], np.nan, dtype=self.dtype)
+        shape = (len(array['nhru']), len(array['variable']))
+        for i, s in enumerate(coords['scenario']):
+            for j, p in enumerate(coords['period']):
+                for k, m in enumerate(coords['month']):
+                    location = array['chunks'].get((str(s), str(p), str(m)))
+                    if location is not None:
+                        values[i, j, k] = self.read_chunk(location, self.dtype, shape)[rows][:, columns]
+        return values, coords
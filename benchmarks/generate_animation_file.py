@@ -0,0 +1,92 @@
+# write synthetic PRMS animation files, for benchmarking (see run_benchmarks.py)
+#
+# usage: python generate_animation_file.py outfile [--nhru N] [--nyears N] [--nvariables N] [--start 1980-10-01]
+#
+# files have the same layout as PRMS animation output: a DBF header with FIELD_DECIMAL/DATETIME lines,
+# a row of column names, a format line, then one tab-delimited record per hru per day
+
+import argparse
+import datetime as dt
+import numpy as np
+
+# state variables from EXAMPLE_process_PRMS_animation.in, with operations and a rough range of daily values
+VARIABLES = [('soil_moist', 'mean', 0, 10), ('recharge', 'sum', 0, 0.5), ('hru_rain', 'sum', 0, 2),
+             ('hru_snow', 'sum', 0, 1), ('potet', 'sum', 0, 0.3), ('hru_actet', 'sum', 0, 0.3),
+             ('pkwater_equiv', 'max', 0, 20), ('snowmelt', 'sum', 0, 1), ('hru_ppt', 'sum', 0, 3),
+             ('tminf', 'mean', -20, 70), ('tmaxf', 'mean', 0, 95), ('hru_streamflow_out', 'mean', 0, 50)]
+
+
+def variable_names(nvariables=len(VARIABLES)):
+    # cycle through the example variables if more are needed
+    names = []
+    for i in range(nvariables):
+        name = VARIABLES[i % len(VARIABLES)][0]
+        if i >= len(VARIABLES):
+            name = '{}{}'.format(name, i // len(VARIABLES))
+        names.append(name)
+    return names
+
+
+def operations(nvariables=len(VARIABLES)):
+    """Operations for the variables in a synthetic file, laid out like Input.operations.
+    """
+    ops = {'nhru': ['mean']}
+    for i, name in enumerate(variable_names(nvariables)):
+        ops[name] = [VARIABLES[i % len(VARIABLES)][1]]
+    return ops
+
+
+def write_animation_file(outfile, nhru=100, nyears=2, nvariables=len(VARIABLES), start='1980-10-01', seed=0):
+    """Write a synthetic animation file with daily records for nhru hrus over nyears.
+
+    Returns
+    -------
+    Number of records written
+    """
+    random = np.random.RandomState(seed)
+    names = variable_names(nvariables)
+    ranges = np.array([VARIABLES[i % len(VARIABLES)][2:] for i in range(nvariables)], dtype=float)
+    start = dt.datetime.strptime(start, '%Y-%m-%d')
+    ndays = (dt.datetime(start.year + nyears, start.month, start.day) - start).days
+    hrus = np.arange(1, nhru + 1)
+
+    # each hru has its own mean for each variable; daily values vary about it, with some zeros
+    hru_means = ranges[:, 0] + (ranges[:, 1] - ranges[:, 0]) * random.uniform(0.2, 0.8, (nhru, nvariables))
+    record = '%s\t%d' + '\t%.4E' * nvariables + '\n'
+
+    with open(outfile, 'w') as output:
+        output.write('#\n# Begin DBF\n')
+        output.write('# timestamp,#FIELD_ISODATETIME,19,0\n')
+        output.write('# nhru,#FIELD_DECIMAL,10,0\n')
+        for name in names:
+            output.write('# {},#FIELD_DECIMAL,10,2\n'.format(name))
+        output.write('# End DBF\n#\n')
+        output.write('\t'.join(['timestamp', 'nhru'] + names) + '\n')
+        output.write('\t'.join(['19d', '10n'] + ['10n'] * nvariables) + '\n')
+
+        for day in range(ndays):
+            timestamp = (start + dt.timedelta(days=day)).strftime('%Y-%m-%d:%H:%M:%S')
+            values = hru_means * random.uniform(0.5, 1.5, (nhru, nvariables))
+            values[random.uniform(size=(nhru, nvariables)) < 0.1] = 0.
+            rows = np.empty((nhru, nvariables + 2), dtype=object)
+            rows[:, 0] = timestamp
+            rows[:, 1] = hrus
+            rows[:, 2:] = values
+            output.write((record * nhru) % tuple(rows.ravel()))
+    return ndays * nhru
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Write a synthetic PRMS animation file.')
+    parser.add_argument('outfile')
+    parser.add_argument('--nhru', type=int, default=100)
+    parser.add_argument('--nyears', type=int, default=2)
+    parser.add_argument('--nvariables', type=int, default=len(VARIABLES))
+    parser.add_argument('--start', default='1980-10-01', help='first day (YYYY-mm-dd)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    nrecords = write_animation_file(args.outfile, nhru=args.nhru, nyears=args.nyears, nvariables=args.nvariables,
+                                    start=args.start, seed=args.seed)
+    print 'wrote {} records to {}'.format(nrecords, args.outfile)
@@ -0,0 +1,190 @@
+# time each stage of the animation processing pipeline on synthetic animation files,
+# and save the results as json, so that runs (e.g. before and after a pandas upgrade) can be compared
+#
+# usage: python run_benchmarks.py [--scales small medium] [--output results.json] [--compare previous.json]
+#
+# each stage runs in a fresh process, so that its peak memory use can be measured separately
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import platform
+import datetime as dt
+import multiprocessing
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import PRMS_animation_classes as prms
+from PRMS_animation_profile import peak_rss_mb
+from generate_animation_file import write_animation_file, operations
+
+# number of hrus, years and variables in the synthetic files
+SCALES = {'small': (100, 2, 12),
+          'medium': (1000, 5, 12),
+          'large': (5000, 20, 12)}
+
+
+def stage_read(files, ops, outdir):
+    return None, lambda: prms.AnimationFile(files['period'])
+
+
+def stage_read_chunked(files, ops, outdir):
+    ani_file = prms.AnimationFile(files['period'], chunksize=100000)
+    return ani_file, lambda: [len(chunk) for chunk in ani_file.iter_chunks()]
+
+
+def stage_annual(files, ops, outdir):
+    ani_file = prms.AnimationFile(files['period'])
+    return ani_file, lambda: prms.PeriodStatistics(ops).Annual(ani_file)
+
+
+def stage_monthly(files, ops, outdir):
+    ani_file = prms.AnimationFile(files['period'])
+    return ani_file, lambda: prms.PeriodStatistics(ops).Monthly(ani_file)
+
+
+def stage_annual_monthly(files, ops, outdir):
+    ani_file = prms.AnimationFile(files['period'])
+    return ani_file, lambda: prms.PeriodStatistics(ops).AnnualMonthly(ani_file)
+
+
+def stage_hru_mean_pct_diff(files, ops, outdir):
+    hs = prms.hruStatistics([files['period']], files['baseline'], error_file=os.path.join(outdir, 'errors.txt'))
+    return hs, hs.hru_mean_pct_diff
+
+
+def stage_write_output(files, ops, outdir):
+    hs = prms.hruStatistics([files['period']], files['baseline'], error_file=os.path.join(outdir, 'errors.txt'))
+    hs.hru_mean_pct_diff()
+    return hs, lambda: hs.write_output(outdir)
+
+
+def stage_compare_engine(files, ops, outdir):
+    engine = prms.hruComparisons(error_file=os.path.join(outdir, 'errors.txt'))
+    return engine, lambda: engine.compare(files['baseline'], [files['period']])
+
+
+STAGES = [('read', stage_read),
+          ('read_chunked', stage_read_chunked),
+          ('annual', stage_annual),
+          ('monthly', stage_monthly),
+          ('annual_monthly', stage_annual_monthly),
+          ('hru_mean_pct_diff', stage_hru_mean_pct_diff),
+          ('write_output', stage_write_output),
+          ('compare_engine', stage_compare_engine)]
+
+
+def run_stage(stage, files, ops, outdir, queue):
+    # runs in a child process: set up the stage, then time it
+    sys.stdout = open(os.devnull, 'w')
+    setup, run = dict(STAGES)[stage](files, ops, outdir)
+    setup_rss = peak_rss_mb()
+    t0 = time.time()
+    run()
+    seconds = time.time() - t0
+    queue.put((seconds, setup_rss, peak_rss_mb()))
+
+
+def time_stage(stage, files, ops, outdir):
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run_stage, args=(stage, files, ops, outdir, queue))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError('benchmark stage {} failed'.format(stage))
+    return queue.get()
+
+
+def run_benchmarks(scales, stages=None, workdir=None, repeat=1):
+    """Generate synthetic animation files at each scale, and time each stage on them.
+
+    Returns
+    -------
+    A list of dictionaries of results, one for each scale and stage
+    """
+    if stages is None:
+        stages = [s for s, f in STAGES]
+    cleanup = workdir is None
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix='prms_benchmarks_')
+
+    results = []
+    try:
+        for scale in scales:
+            nhru, nyears, nvariables = SCALES[scale]
+            files = {}
+            for i, name in enumerate(['baseline', 'period']):
+                files[name] = os.path.join(workdir, '{}_{}.animation.nhru'.format(scale, name))
+                nrows = write_animation_file(files[name], nhru=nhru, nyears=nyears, nvariables=nvariables, seed=i)
+            ops = operations(nvariables)
+            outdir = os.path.join(workdir, '{}_output'.format(scale))
+            if not os.path.isdir(outdir):
+                os.makedirs(outdir)
+            for stage in stages:
+                seconds, setup_rss, peak_rss = min([time_stage(stage, files, ops, outdir) for i in range(repeat)])
+                results.append({'scale': scale, 'nhru': nhru, 'nyears': nyears, 'nvariables': nvariables,
+                                'rows': nrows, 'stage': stage, 'seconds': seconds,
+                                'rows_per_second': nrows / seconds if seconds > 0 else None,
+                                'setup_rss_mb': setup_rss, 'peak_rss_mb': peak_rss})
+                print '{:8s} {:20s} {:10.3f} s {:>10} MB peak'.format(scale, stage, seconds,
+                                                                      '{:.1f}'.format(peak_rss) if peak_rss else '-')
+    finally:
+        if cleanup:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def compare_results(results, previous, threshold=0.1):
+    """Print the change in time for each stage relative to a previous run, flagging slowdowns beyond threshold.
+
+    Returns
+    -------
+    A list of (scale, stage) pairs that were slower
+    """
+    previous = dict([((r['scale'], r['stage']), r) for r in previous['results']])
+    regressions = []
+    for r in results:
+        old = previous.get((r['scale'], r['stage']))
+        if old is None or old['seconds'] <= 0:
+            continue
+        change = r['seconds'] / old['seconds'] - 1
+        flag = ''
+        if change > threshold:
+            flag = '  <-- slower'
+            regressions.append((r['scale'], r['stage']))
+        print '{:8s} {:20s} {:10.3f} s {:+8.1%}{}'.format(r['scale'], r['stage'], r['seconds'], change, flag)
+    return regressions
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the PRMS animation processing pipeline.')
+    parser.add_argument('--scales', nargs='+', default=['small', 'medium'], choices=sorted(SCALES.keys()))
+    parser.add_argument('--stages', nargs='+', default=None, choices=[s for s, f in STAGES])
+    parser.add_argument('--repeat', type=int, default=1, help='number of times to run each stage (fastest is kept)')
+    parser.add_argument('--workdir', default=None, help='folder for the synthetic files (kept afterwards)')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', default=None, help='json results from a previous run')
+    parser.add_argument('--threshold', type=float, default=0.1, help='fractional slowdown to flag')
+    args = parser.parse_args()
+
+    if args.workdir is not None and not os.path.isdir(args.workdir):
+        os.makedirs(args.workdir)
+    results = run_benchmarks(args.scales, stages=args.stages, workdir=args.workdir, repeat=args.repeat)
+
+    meta = {'date': dt.datetime.now().isoformat(), 'python': platform.python_version(),
+            'numpy': np.__version__, 'pandas': pd.__version__, 'platform': platform.platform()}
+    with open(args.output, 'w') as output:
+        json.dump({'meta': meta, 'results': results}, output, indent=1)
+    print 'wrote {}'.format(args.output)
+
+    if args.compare is not None:
+        with open(args.compare) as input_file:
+            regressions = compare_results(results, json.load(input_file), threshold=args.threshold)
+        if len(regressions) > 0:
+            sys.exit(1)
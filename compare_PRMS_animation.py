@@ -0,0 +1,156 @@
+# script to compare PRMS animation files for future periods with a baseline period, for each gcm (and month),
+# using hruStatistics in PRMS_animation_classes (see examples/AnimationMeansPctDiffs.ipynb)
+#
+# usage: python compare_PRMS_animation.py animation_dir output_dir [--baseline 1981-2000] [--nyears N]
+#                                         [--prefetch N] [--shards N] [--profile report.json]
+#                                         [--nonfinite nonfinite.csv] [--max-indices N]
+#                                         [--store results.store [--store-only]]
+#
+# animation files are named <gcm>.<scenario>.<period>.<month or annual>.animation.nhru;
+# each period file is compared with the baseline file for the same gcm and month
+#
+# completed comparisons are recorded in a manifest in the output folder, so a re-run only
+# repeats comparisons whose input files (or settings) have changed, and a killed run picks up where it stopped
+#
+# hrus with nan or inf percent differences (e.g. from zero baseline means) are listed as ranges in the error file;
+# with --nonfinite, the counts of each kind for each file and column are also written to a csv or json report
+#
+# with --store, the means and percent differences are also written to a single consolidated store
+# (see PRMS_animation_store); with --store-only, the .nhru files aren't written
+
+import os
+import sys
+import argparse
+import traceback
+import PRMS_animation_classes as prms
+from PRMS_animation_cache import AnimationCache
+from PRMS_animation_manifest import Manifest
+from PRMS_animation_profile import profiler
+from PRMS_animation_store import ResultStore, file_labels
+
+
+def find_comparisons(animation_files, baseline_per='1981-2000'):
+    """Group animation files by gcm and month, and pair each group's period files with its baseline file.
+
+    Returns
+    -------
+    A list of (gcm, month, baseline file, list of period files) tuples
+    """
+    groups = {}
+    for f in sorted(animation_files):
+        name = os.path.split(f)[1]
+        gcm, month = name.split('.')[0], name.split('.')[-3]
+        groups.setdefault((gcm, month), []).append(f)
+
+    comparisons = []
+    for (gcm, month), files in sorted(groups.items()):
+        baseline = [f for f in files if baseline_per in os.path.split(f)[1]]
+        if len(baseline) == 0:
+            print 'Warning, no {} baseline for {} {}; skipping'.format(baseline_per, gcm, month)
+            continue
+        period_files = [f for f in files if f != baseline[0]]
+        comparisons.append((gcm, month, baseline[0], period_files))
+    return comparisons
+
+
+def run_comparisons(comparisons, outdir, nyears=None, chunksize=None, cache=None, prefetch=None, shards=None,
+                    max_indices=None, nonfinite_report=None, store=None, nhru_output=True):
+    """Compute hru means and percent differences from baseline for each comparison,
+    skipping any that are already complete in the manifest for outdir.
+    Each animation file is only read once (see hruComparisons); with prefetch,
+    up to that many files for each comparison are read at once, in background threads;
+    with shards, the hrus of each file are split among that many processes.
+    If nonfinite_report is a file name, a report of the non-finite percent differences is written to it,
+    with up to max_indices hrus listed for each file, column and kind (see PRMS_animation_diagnostics).
+    With a store (ResultStore), the results are also written to it (comparisons that aren't in the store
+    are repeated), and the .nhru files are only written if nhru_output is True.
+
+    Returns
+    -------
+    A dictionary of tracebacks for any comparisons that failed, keyed by (gcm, month)
+    """
+    manifest = Manifest(outdir)
+    config = {'nyears': nyears}
+    if not nhru_output:
+        # (so that a later run with .nhru files repeats the comparisons)
+        config['nhru_output'] = False
+    engine = prms.hruComparisons(nyears=nyears, chunksize=chunksize, cache=cache, prefetch=prefetch,
+                                 shards=shards, max_indices=max_indices, store=store,
+                                 error_file=os.path.join(outdir, 'hruComparisons_errors.txt'))
+    failed = {}
+    for c, (gcm, month, baseline, period_files) in enumerate(comparisons):
+        # one job for each baseline-period pair, and one for the baseline means
+        # (rewritten whenever any of its periods are computed)
+        jobs = dict([(pf, '{}|{}'.format(baseline, pf)) for pf in period_files])
+        stale = [pf for pf in period_files if not manifest.is_current(jobs[pf], [baseline, pf], config)]
+        if not manifest.is_current(baseline, [baseline], config):
+            stale = period_files
+        if store is not None:
+            stale = [pf for pf in period_files if pf in stale or not store.has('hru_pct_diff', *file_labels(pf))]
+            if not store.has('hru_means', *file_labels(baseline)):
+                stale = period_files
+        print "\n{0} of {1}: {2} {3}, {4} of {5} periods to compute".format(c+1, len(comparisons), gcm, month,
+                                                                      len(stale), len(period_files))
+        if len(stale) == 0:
+            continue
+        try:
+            engine.compare(baseline, stale)
+            outfiles = engine.write_output(outdir, baseline, stale, nhru_output=nhru_output)
+        except Exception:
+            failed[(gcm, month)] = traceback.format_exc()
+            print "failed: {} {}".format(gcm, month)
+            continue
+        manifest.record(baseline, [baseline], outfiles[baseline], config)
+        for pf in stale:
+            manifest.record(jobs[pf], [baseline, pf], outfiles[pf], config)
+    engine.close()
+    if nonfinite_report is not None:
+        engine.nonfinite.write(nonfinite_report)
+
+    for (gcm, month), error in failed.iteritems():
+        print "\nError comparing {0} {1}:\n{2}".format(gcm, month, error)
+    return failed
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Compute hru means and percent differences from a baseline period.')
+    parser.add_argument('animation_dir', help='folder of annual or monthly animation files')
+    parser.add_argument('output_dir')
+    parser.add_argument('--baseline', default='1981-2000', help='baseline period in the file names')
+    parser.add_argument('--nyears', type=int, default=None, help='only use the last nyears of each file')
+    parser.add_argument('--chunksize', type=int, default=None, help='read animation files in blocks of this many rows')
+    parser.add_argument('--cache', default=None, help='folder for caching parsed animation files')
+    parser.add_argument('--prefetch', type=int, default=None, help='number of files to read at once')
+    parser.add_argument('--shards', type=int, default=None,
+                        help='number of processes to split the hrus of each file among')
+    parser.add_argument('--profile', default=None, help='write a json (or .csv) report of time spent in each stage')
+    parser.add_argument('--nonfinite', default=None,
+                        help='write a csv (or .json) report of nan and inf percent differences')
+    parser.add_argument('--max-indices', type=int, default=None,
+                        help='number of hrus to list for each kind of non-finite value in each column')
+    parser.add_argument('--store', default=None, help='also write the results to this consolidated store')
+    parser.add_argument('--store-only', action='store_true', help='only write the results to the store')
+    args = parser.parse_args()
+
+    animation_files = [os.path.join(args.animation_dir, f) for f in os.listdir(args.animation_dir)
+                       if f.endswith('.nhru')]
+    cache = None
+    if args.cache is not None:
+        cache = AnimationCache(args.cache)
+    store = None
+    if args.store is not None:
+        store = ResultStore(args.store)
+
+    if args.profile is not None:
+        profiler.enable()
+
+    comparisons = find_comparisons(animation_files, args.baseline)
+    failed = run_comparisons(comparisons, args.output_dir, nyears=args.nyears, chunksize=args.chunksize, cache=cache,
+                             prefetch=args.prefetch, shards=args.shards, max_indices=args.max_indices,
+                             nonfinite_report=args.nonfinite, store=store,
+                             nhru_output=store is None or not args.store_only)
+    if args.profile is not None:
+        profiler.report(args.profile)
+    if len(failed) > 0:
+        sys.exit(1)
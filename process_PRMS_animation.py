@@ -1,24 +1,208 @@
 # example script to process multiple PRMS animation files using classes in PRMS_animation_classes
+#
+# usage: python process_PRMS_animation.py [configfile] [--jobs N] [--chunksize N] [--cache DIR] [--csv]
+#                                         [--float32] [--prefetch N] [--shards N] [--profile report.json]
+#                                         [--inventory] [--store results.store [--store-only]]
+#
+# files are processed independently, so with --jobs N they are spread across N worker processes;
+# a file that fails is reported at the end, without stopping the rest of the batch
+# with --prefetch N (and one job), the next N files are read in background threads while each file is processed
+# with --shards N (and one job), the hrus of each file are split among N processes
+# only the columns named in the operations are read; with --float32 they are kept as 32-bit floats
+# with --profile, the time, rows and resident memory for each stage of processing each file
+# are written to a json or csv report at the end (see PRMS_animation_profile)
+# with --inventory, only the headers, date ranges and hru counts of the files are read and listed
+# (flagging any that don't line up with the first file), and nothing is processed
+# with --store (and one job), the annual and monthly statistics are also written to a single consolidated store
+# (see PRMS_animation_store); with --store-only, the .nhru files aren't written
 
+import sys
+import argparse
+import itertools
+import multiprocessing
+import traceback
 import PRMS_animation_classes as prms
+from PRMS_animation_cache import AnimationCache
+from PRMS_animation_profile import profiler
+from PRMS_animation_store import ResultStore
 
-configfile = 'EXAMPLE_process_PRMS_animation.in'
 
-input = prms.Input(configfile)
-c=0
-for infile in input.input_files:
-    c+=1
-    print "\n{0} of {1}".format(c,len(input.input_files))
+def read_file(infile, operations, chunksize=None, cache=None, float32=False):
+    # read PRMS animation file into object
+    # (only the columns that have operations)
+    return prms.AnimationFile(infile, chunksize=chunksize, cache=cache, columns=operations.keys(), float32=float32)
+
+
+def process_file(infile, operations, chunksize=None, cache=None, csv_output=False, float32=False, shards=None,
+                 store=None, nhru_output=True, indata=None):
     # dictionary to determine annual aggregation of variables (e.g. whether mean or sum)
     #f = {'nhru':['mean'], 'soil_moist':['mean'], 'recharge':['sum'], 'hru_ppt':['sum'], 'hru_rain':['sum'], 'hru_snow':['sum'], 'tminf':['mean'], 'tmaxf':['mean'], 'potet':['sum'], 'hru_actet':['sum'], 'pkwater_equiv':['max'], 'snowmelt':['sum'], 'hru_streamflow_out':['mean']}
 
-    # read PRMS animation file into object
-    indata = prms.AnimationFile(infile)
+    # store (optional): ResultStore to also write the statistics to; nhru_output (T/F): write .nhru files
+    # indata (optional): the file, if it has already been read (see read_file)
+    if indata is None:
+        indata = read_file(infile, operations, chunksize=chunksize, cache=cache, float32=float32)
 
     # calculate period statistics (and write to output files)
-    stats = prms.PeriodStatistics(input.operations)
+    stats = prms.PeriodStatistics(operations, shards=shards, store=store)
+
+    # annual and monthly statistics are computed from a single pass through the data
+    stats.AnnualMonthly(indata, csv_output=csv_output, ani_output=nhru_output and not csv_output)
+
+
+def _process_file(args):
+    # returns the error for a file instead of raising it, so that the rest of the batch can continue
+    # (along with the profile records for the file, if profiling is on)
+    profile, args = args[-1], args[:-1]
+    profiler.enabled = profile
+    profiler.clear()
+    try:
+        process_file(*args)
+    except Exception:
+        return args[0], traceback.format_exc(), profiler.results()
+    return args[0], None, profiler.results()
+
+
+def _prefetch_batch(tasks, size):
+    # process the files one at a time, while the next ones are read in background threads;
+    # returns the same results as _process_file (profile records are collected at the end of the batch instead)
+    def read(task):
+        infile, operations, chunksize, cache, csv_output, float32, shards, store, nhru_output, profile = task
+        try:
+            return read_file(infile, operations, chunksize=chunksize, cache=cache, float32=float32), None
+        except Exception:
+            return None, traceback.format_exc()
+
+    for task, (indata, error) in prms.prefetch_files(read, tasks, size=size):
+        if error is None:
+            try:
+                process_file(*task[:-1], indata=indata)
+            except Exception:
+                error = traceback.format_exc()
+        del indata
+        yield task[0], error, []
+
+
+def inventory(input_files):
+    """List the date range, number of hrus and number of columns of each animation file,
+    from the header and the first and last records only (see AnimationFile.inventory).
+    Files whose columns or number of hrus differ from the first file are flagged.
+
+    Returns
+    -------
+    A list of the inventory dictionaries for the files that could be read,
+    and a dictionary of tracebacks for any that couldn't, keyed by file name
+    """
+    files, failed = [], {}
+    for infile in input_files:
+        try:
+            files.append(prms.AnimationFile(infile, lazy=True).inventory())
+        except Exception:
+            failed[infile] = traceback.format_exc()
+
+    print '{:>12s} {:>8s} {:>8s}  {:19s}  {:19s}  {}'.format('MB', 'nhru', 'columns', 'start', 'end', 'file')
+    for f in files:
+        flag = ''
+        if f['columns'] != files[0]['columns'] or f['nhru'] != files[0]['nhru']:
+            flag = '  <-- differs from {}'.format(files[0]['file'])
+        print '{:12.1f} {:8d} {:8d}  {:19s}  {:19s}  {}{}'.format(f['size'] / 2.**20, f['nhru'], len(f['columns']),
+                                                                  str(f['start']), str(f['end']), f['file'], flag)
+    for infile, error in failed.iteritems():
+        print "\nError reading {0}:\n{1}".format(infile, error)
+    return files, failed
+
+
+def run_batch(input_files, operations, jobs=1, chunksize=None, cache=None, csv_output=False, float32=False,
+              prefetch=None, shards=None, store=None, nhru_output=True, profile=None):
+    """Process a list of animation files, optionally in a pool of worker processes,
+    or with the next prefetch files read in background threads.
+    If profile is a file name, a report of the time spent in each stage for each file is written to it
+    (see PRMS_animation_profile). With a store (ResultStore), the statistics are also written to it,
+    and the .nhru files are only written if nhru_output is True.
+
+    Returns
+    -------
+    A dictionary of tracebacks for any files that failed, keyed by file name
+    """
+    if jobs > 1 and shards is not None:
+        raise ValueError('Files can\'t be split into shards when processing more than one file at once.')
+    if jobs > 1 and store is not None:
+        raise ValueError('Only one process can write to the store at a time.')
+    tasks = [(infile, operations, chunksize, cache, csv_output, float32, shards, store, nhru_output,
+              profile is not None) for infile in input_files]
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap_unordered(_process_file, tasks)
+    elif prefetch is not None:
+        pool = None
+        profiler.enabled = profile is not None
+        profiler.clear()
+        results = _prefetch_batch(tasks, prefetch)
+    else:
+        pool = None
+        results = itertools.imap(_process_file, tasks)
+
+    failed = {}
+    records = []
+    for c, (infile, error, profile_records) in enumerate(results):
+        records += profile_records
+        if error is None:
+            print "\n{0} of {1} finished: {2}".format(c+1, len(tasks), infile)
+        else:
+            print "\n{0} of {1} failed: {2}".format(c+1, len(tasks), infile)
+            failed[infile] = error
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    for infile, error in failed.iteritems():
+        print "\nError processing {0}:\n{1}".format(infile, error)
+
+    if profile is not None:
+        if jobs <= 1 and prefetch is not None:
+            records = profiler.results()
+        profiler.clear()
+        profiler.merge(records)
+        profiler.report(profile)
+    return failed
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Compute annual and monthly statistics for PRMS animation files.')
+    parser.add_argument('configfile', nargs='?', default='EXAMPLE_process_PRMS_animation.in')
+    parser.add_argument('--jobs', type=int, default=1, help='number of files to process at once')
+    parser.add_argument('--chunksize', type=int, default=None, help='read animation files in blocks of this many rows')
+    parser.add_argument('--cache', default=None, help='folder for caching parsed animation files')
+    parser.add_argument('--csv', action='store_true', help='write csv files instead of animation files')
+    parser.add_argument('--float32', action='store_true', help='keep state variables as 32-bit floats in memory')
+    parser.add_argument('--prefetch', type=int, default=None,
+                        help='number of files to read ahead in background threads (with one job)')
+    parser.add_argument('--shards', type=int, default=None,
+                        help='number of processes to split the hrus of each file among (with one job)')
+    parser.add_argument('--profile', default=None, help='write a json (or .csv) report of time spent in each stage')
+    parser.add_argument('--store', default=None,
+                        help='also write the statistics to this consolidated store (with one job)')
+    parser.add_argument('--store-only', action='store_true', help='only write the statistics to the store')
+    parser.add_argument('--inventory', action='store_true',
+                        help='only list the date range and number of hrus of each file (from the headers)')
+    args = parser.parse_args()
+
+    input = prms.Input(args.configfile)
+    if args.inventory:
+        files, failed = inventory(input.input_files)
+        sys.exit(1 if len(failed) > 0 else 0)
 
-    stats.Annual(indata, format_line=True)
+    cache = None
+    if args.cache is not None:
+        cache = AnimationCache(args.cache)
+    store = None
+    if args.store is not None:
+        store = ResultStore(args.store)
 
-    stats.Monthly(indata, format_line=True)
-    
+    failed = run_batch(input.input_files, input.operations, jobs=args.jobs, chunksize=args.chunksize,
+                       cache=cache, csv_output=args.csv, float32=args.float32,
+                       prefetch=args.prefetch, shards=args.shards, store=store,
+                       nhru_output=store is None or not args.store_only, profile=args.profile)
+    if len(failed) > 0:
+        sys.exit(1)
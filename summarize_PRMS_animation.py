@@ -0,0 +1,51 @@
+# script to summarize hru means and percent differences across all of the gcms, scenarios, periods and months
+# compared by compare_PRMS_animation.py (e.g. to choose bins for maps), without loading them all at once
+#
+# usage: python summarize_PRMS_animation.py output_dir [output_dir ...] --summary_dir DIR [--percentiles 0.1 0.9]
+#
+# for each kind of output (hru_means and hru_pct_diff), writes:
+# <kind>_summary.csv: count, mean, std, min, percentiles and max of each variable (as from dataframe.describe())
+# <kind>_summary.json: the running statistics, which can be merged with later runs (see PRMS_animation_ensemble)
+# <kind>_ensemble/<scenario>.<period>.<month>...csv: median and spread across gcms for each hru
+
+import os
+import argparse
+from PRMS_animation_ensemble import EnsembleSummary, ensemble_groups, hru_ensemble
+
+
+def summarize(output_dirs, summary_dir, percentiles=[0.1, 0.9]):
+    if not os.path.isdir(summary_dir):
+        os.makedirs(summary_dir)
+    for kind in ['hru_means', 'hru_pct_diff']:
+        files = []
+        for outdir in output_dirs:
+            if os.path.isdir(os.path.join(outdir, kind)):
+                files += [os.path.join(outdir, kind, f) for f in os.listdir(os.path.join(outdir, kind))
+                          if f.endswith('.nhru')]
+        if len(files) == 0:
+            continue
+
+        print "summarizing {} {} files...".format(len(files), kind)
+        summary = EnsembleSummary(percentiles)
+        for f in sorted(files):
+            summary.add_file(f)
+        summary.describe().to_csv(os.path.join(summary_dir, '{}_summary.csv'.format(kind)))
+        summary.save(os.path.join(summary_dir, '{}_summary.json'.format(kind)))
+
+        ensemble_dir = os.path.join(summary_dir, '{}_ensemble'.format(kind))
+        if not os.path.isdir(ensemble_dir):
+            os.makedirs(ensemble_dir)
+        for group, group_files in sorted(ensemble_groups(files).items()):
+            hru_ensemble(group_files).to_csv(os.path.join(ensemble_dir, '{}.csv'.format(group[:-5])),
+                                             index_label='nhru')
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Summarize hru means and percent differences across an ensemble.')
+    parser.add_argument('output_dirs', nargs='+', help='output folders from compare_PRMS_animation.py')
+    parser.add_argument('--summary_dir', required=True)
+    parser.add_argument('--percentiles', type=float, nargs='+', default=[0.1, 0.9])
+    args = parser.parse_args()
+
+    summarize(args.output_dirs, args.summary_dir, args.percentiles)